@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+CCD reductions in NumPy, in place of the ccdred package.
+
+Images are memory mapped and worked on a block of rows at a time, so the
+memory needed depends on the size of one image and not on how many images
+there are.
+
+low level functions: calibration_image, ccd_sections, fix_pixels,
+                     open_frame, overscan_level, read_block, read_mask,
+                     row_blocks, write_frame
+high level functions: combine_frames, combine_zero_flats, process_galaxy
+"""
+
+import os
+import os.path
+import numpy
+import pyfits
+from .data import get_group, get_groups
+from .iraf_low import imcopy
+from .misc import fits_name, parse_section, read_list
+from .spectra import combine
+
+
+# number of rows of every image worked on at once
+BLOCK = 64
+
+# overscan and trim sections used if neither the group nor the images give
+# them, those of the instrument this was written for
+BIASSEC = '[2049:2080,1:501]'
+TRIMSEC = '[1:2048,1:501]'
+
+# rejection of the overscan fit, that of ccdproc by default: points more
+# than this many standard deviations from the fit are rejected this many
+# times
+OVERSCAN_REJECT = 3.
+OVERSCAN_ITERATIONS = 1
+
+# flat values below this are replaced by it, the minreplace of ccdproc
+MINREPLACE = 1.
+
+
+## Low level functions ##
+
+
+def calibration_image(fn, biassec, trimsec):
+    """Return a zero or flat image with its overscan level subtracted and
+       trimmed, as ccdproc does to calibration images it is given, unless
+       it has been trimmed already."""
+    frame = open_frame(fn)
+    if 'TRIM' in frame[1]:
+        return read_block(frame, slice(None))
+    (rows, columns) = parse_section(trimsec)
+    return read_block(frame, rows, columns) - overscan_level(frame, biassec)
+
+
+def ccd_sections(group, header):
+    """Return the overscan and trim sections for the images of a group,
+       taken from the biassec and trimsec entries of the group if there are
+       any, then from the BIASSEC and TRIMSEC keywords of an image header,
+       and otherwise from BIASSEC and TRIMSEC here."""
+    sections = []
+    for (key, default) in (('biassec', BIASSEC), ('trimsec', TRIMSEC)):
+        sections.append(group.get(key, header.get(key.upper(), default)))
+    return tuple(sections)
+
+
+def fix_pixels(data, bad):
+    """Replace the bad pixels of an image in place by interpolating linearly
+       along each line between the nearest good pixels, as fixpix does for
+       narrow defects. Bad pixels at the end of a line take the value of
+       the last good one."""
+    columns = numpy.arange(data.shape[1])
+    for row in bad.any(axis=1).nonzero()[0]:
+        good = ~bad[row]
+        if good.any():
+            data[row, bad[row]] = numpy.interp(columns[bad[row]],
+                                               columns[good], data[row, good])
+
+
+def open_frame(fn):
+    """Open an image memory mapped, returning the raw data, the header, and
+       the scale and zero point that convert the raw data to values. The
+       data isn't scaled here, since that would read the whole image."""
+    hdulist = pyfits.open(fits_name(fn), memmap=True,
+                          do_not_scale_image_data=True)
+    header = hdulist[0].header
+    return (hdulist[0].data, header, header.get('BSCALE', 1.),
+            header.get('BZERO', 0.))
+
+
+def overscan_level(frame, biassec):
+    """Return the level of the overscan region of an image, which is what
+       ccdproc subtracts with its default overscan fit of order one: the
+       overscan is averaged along each line, and the mean of the averages
+       taken after rejecting those more than OVERSCAN_REJECT standard
+       deviations from it, OVERSCAN_ITERATIONS times."""
+    (rows, columns) = parse_section(biassec)
+    values = numpy.ma.masked_invalid(read_block(frame, rows,
+                                                columns).mean(axis=1))
+    for i in range(OVERSCAN_ITERATIONS):
+        deviation = abs(values - values.mean())
+        values = numpy.ma.masked_where(
+            deviation > OVERSCAN_REJECT * values.std(), values)
+    return float(values.mean())
+
+
+def read_block(frame, rows, columns=slice(None)):
+    """Return part of an image opened with open_frame as a float array."""
+    (data, header, bscale, bzero) = frame
+    return data[rows, columns] * float(bscale) + bzero
+
+
+def read_mask(mask):
+    """Return a bad pixel mask as a boolean array that is true for bad
+       pixels. IRAF pixel lists, which pyfits can't read, are copied to a
+       FITS image of the same name with imcopy the first time."""
+    fn = mask
+    if mask.endswith('.pl'):
+        fn = '%s.fits' % mask[:-3]
+        if (not os.path.isfile(fn) or
+            os.path.getmtime(fn) < os.path.getmtime(mask)):
+            if os.path.isfile(fn):
+                os.remove(fn)
+            imcopy(mask, fn)
+    return pyfits.getdata(fn) != 0
+
+
+def row_blocks(rows):
+    """Return slices covering an image with the given number of rows a
+       block at a time."""
+    return [slice(start, min(start + BLOCK, rows))
+            for start in range(0, rows, BLOCK)]
+
+
+def write_frame(fn, data, header):
+    """Write an image in single precision with a copy of the header of one
+       of the images it was made from, replacing any file already there."""
+    header = header.copy()
+    for keyword in ('BSCALE', 'BZERO'):
+        if keyword in header:
+            del header[keyword]
+    pyfits.writeto(fits_name(fn), numpy.asarray(data, dtype=numpy.float32),
+                   header, clobber=True)
+
+
+## High level functions ##
+
+
+def combine_frames(infiles, outfile, method='sigclip', scale=False,
+                   mask=None):
+    """Combine images with the given method (see spectra.combine), a block
+       of rows at a time, as zerocombine and flatcombine do.
+
+       If scale is set, as for flats, each image is first scaled so that its
+       median matches the mean of the medians. If a bad pixel mask is given,
+       bad pixels in the result are fixed with fix_pixels and the mask is
+       recorded in the BPM keyword, as hedit and fixpix would."""
+    frames = [open_frame(fn) for fn in infiles]
+    (rows, columns) = frames[0][0].shape
+    factors = numpy.ones(len(frames))
+    if scale:
+        levels = numpy.array([numpy.median(read_block(frame, slice(None)))
+                              for frame in frames])
+        factors = levels.mean() / levels
+    if mask is not None:
+        bad = read_mask(mask)
+    result = numpy.empty((rows, columns), dtype=numpy.float32)
+    for block in row_blocks(rows):
+        stacked = numpy.array([read_block(frame, block) for frame in frames])
+        stacked *= factors[:, numpy.newaxis, numpy.newaxis]
+        combined = combine(stacked, method)
+        if mask is not None:
+            fix_pixels(combined, bad[block])
+        result[block] = combined
+    header = frames[0][1].copy()
+    header['NCOMBINE'] = len(frames)
+    if mask is not None:
+        header['BPM'] = mask
+    write_frame(outfile, result, header)
+
+
+def combine_zero_flats(method='sigclip'):
+    """Combine the zeros and flats for a night and fix their bad pixels,
+       making the same images as iraf_high.zero_flats."""
+    done = []
+    for group in get_groups():
+        for key in ('zero', 'flat'):
+            if group[key] not in done:
+                done.append(group[key])
+                infiles = read_list('lists/%s' % group[key])
+                combine_frames(infiles, group[key], method, key == 'flat',
+                               group['mask'])
+
+
+def process_galaxy(name, method='sigclip'):
+    """Process the images of a galaxy and combine them into ./name/base.fits
+       in one pass, in place of the imcopy, fixpix, ccdproc and combine run
+       by init_galaxy.
+
+       Each block of rows of each raw image is read once, its bad pixels
+       fixed, its overscan level subtracted, trimmed, zero corrected and
+       divided by the flat normalized to a mean of one, and the processed
+       blocks are combined with the given method (see spectra.combine).
+       As in ccdproc, flat values below MINREPLACE are replaced by it
+       after the mean is taken."""
+    group = get_group(name)
+    if not os.path.isdir(name):
+        os.mkdir(name)
+    frames = [open_frame(fn) for fn in read_list('lists/%s' % name)]
+    (biassec, trimsec) = ccd_sections(group, frames[0][1])
+    zero = calibration_image(group['zero'], biassec, trimsec)
+    flat = calibration_image(group['flat'], biassec, trimsec) - zero
+    flat = numpy.maximum(flat, MINREPLACE) / flat.mean()
+    levels = [overscan_level(frame, biassec) for frame in frames]
+    bad = read_mask(group['mask'])
+    (rows, columns) = parse_section(trimsec)
+    result = numpy.empty(zero.shape, dtype=numpy.float32)
+    for block in row_blocks(len(zero)):
+        raw = slice(rows.start + block.start, rows.start + block.stop)
+        processed = []
+        for frame, level in zip(frames, levels):
+            data = read_block(frame, raw)
+            fix_pixels(data, bad[raw])
+            processed.append((data[:, columns] - level - zero[block]) /
+                             flat[block])
+        result[block] = combine(numpy.array(processed), method)
+    header = frames[0][1].copy()
+    header['NCOMBINE'] = len(frames)
+    header['BPM'] = group['mask']
+    header['LTV1'] = -float(columns.start)
+    header['LTV2'] = -float(rows.start)
+    header['OVERSCAN'] = 'Overscan section is %s' % biassec
+    header['TRIM'] = 'Trim data section is %s' % trimsec
+    header['ZEROCOR'] = 'Zero level correction image is %s' % group['zero']
+    header['FLATCOR'] = 'Flat field image is %s' % group['flat']
+    header['CCDPROC'] = 'CCD processing done'
+    write_frame('%s/base' % name, result, header)
@@ -4,6 +4,7 @@
 """
 Functions for working with metadata about the observations.
 
+cache: MetadataCache, CACHE
 low level: get, get_groups, get_mslit_data, write
 manipulation functions: get_group, get_object_spectra, get_sky_spectra
                         init_data
@@ -11,26 +12,100 @@ calculation functions: calculate_angles, calculate_sections,
                        calculate_pixel_coordinates
 """
 from __future__ import with_statement
+import copy
 import math
+import os
 import os.path
 import yaml
 from .misc import avg, threshold_round
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+
+## Cache ##
+
+
+class MetadataCache:
+    """A cache of parsed metadata files.
+
+       Entries are keyed on the path, modification time and size of the
+       file, so a file changed by anything else is parsed again, and files
+       written with write are forgotten straight away. A copy is returned
+       each time, so callers can change what they are given. Parses done
+       and avoided are counted in parses and avoided."""
+
+    def __init__(self):
+        self.parses = 0     # files parsed
+        self.avoided = 0    # reads served without parsing
+        self.entries = {}   # path: (mtime, size, data)
+        self.index = {}     # groups file path: {name: group}
+
+    def clear(self):
+        """Forget every cached file and reset the counters."""
+        self.parses = 0
+        self.avoided = 0
+        self.entries = {}
+        self.index = {}
+
+    def forget(self, fn):
+        """Forget a file, so that it is parsed again when next read."""
+        path = os.path.abspath(fn)
+        self.entries.pop(path, None)
+        self.index.pop(path, None)
+
+    def get(self, fn):
+        """Return a copy of the parsed contents of a YAML file."""
+        return copy.deepcopy(self.load(fn))
+
+    def group(self, fn, name):
+        """Return a copy of the group in a groups file that a galaxy, star
+           or any other entry of a group is named in, or None. The first
+           group naming it is used."""
+        path = os.path.abspath(fn)
+        groups = self.load(path)
+        if path not in self.index:
+            index = {}
+            for group in groups:
+                for value in group.values():
+                    if not isinstance(value, (list, dict)):
+                        index.setdefault(value, group)
+            self.index[path] = index
+        return copy.deepcopy(self.index[path].get(name))
+
+    def load(self, fn):
+        """Return the parsed contents of a YAML file, shared with the
+           cache."""
+        path = os.path.abspath(fn)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+            self.avoided += 1
+            return entry[2]
+        self.parses += 1
+        self.index.pop(path, None)
+        with open(path) as f:
+            data = yaml.load(f, Loader=Loader)
+        self.entries[path] = (stat.st_mtime, stat.st_size, data)
+        return data
+
+
+# the cache shared by all metadata readers in this process
+CACHE = MetadataCache()
+
 
 ## Functions for low level reading and writing ##
 
 
 def get(name, suffix):
     """Get the contents of a previously saved metadata file."""
-    fn = 'input/%s-%s.yaml' % (name, suffix)
-    with open(fn) as f:
-        return yaml.load(f)
+    return CACHE.get('input/%s-%s.yaml' % (name, suffix))
 
 
 def get_groups():
     """Get the contents of the groups file."""
-    fn = 'input/groups.yaml'
-    with open(fn) as f:
-        return yaml.load(f.read())
+    return CACHE.get('input/groups.yaml')
 
 
 def get_mslit_data(name):
@@ -53,6 +128,7 @@ def get_mslit_data(name):
 def write(name, suffix, data):
     """Write some metadata to disk."""
     fn = 'input/%s-%s.yaml' % (name, suffix)
+    CACHE.forget(fn)
     with open(fn, 'w') as f:
         f.write(yaml.dump(data))
 
@@ -61,10 +137,7 @@ def write(name, suffix, data):
 
 def get_group(name):
     """Return the group data for a given galaxy or star."""
-    groups = get_groups()
-    for group in groups:
-        if name in group.values():
-            return group
+    return CACHE.group('input/groups.yaml', name)
 
 
 def get_object_spectra(name):
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Dispersion correction in NumPy, in place of dispcor.
+
+The dispersion solutions written by identify and reidentify are read from
+./database, evaluated for every spectrum of a galaxy at once, and each
+spectrum is resampled onto a linear wavelength grid conserving flux, the
+defaults of dispcor.
+
+database functions: read_solution, solution_file
+evaluation functions: evaluate, evaluate_group
+resampling functions: linear_grid, resample
+high level functions: dispersion_galaxy, dispersion_header
+"""
+
+from __future__ import with_statement
+import os
+import numpy
+import numpy.polynomial.chebyshev
+import numpy.polynomial.legendre
+from .data import get_group, get_object_spectra, get_sky_spectra
+from .misc import zerocount
+from .spectra import load_spectrum, write_spectrum
+
+
+# the curve types of the IRAF curfit package, by the number it stores
+FUNCTIONS = {1: 'chebyshev', 2: 'legendre', 3: 'spline3', 4: 'spline1'}
+
+
+## Database functions ##
+
+
+def read_solution(fn):
+    """Return the dispersion solution in an identify database file, as a
+       dictionary of the curve type, the range of pixels it was fit over,
+       the coefficients and any shift. If the file holds more than one
+       solution, the last is used, as it is by dispcor."""
+    with open(fn) as f:
+        lines = [line.split() for line in f if line.strip()]
+    begins = [i for i, line in enumerate(lines) if line[0] == 'begin']
+    block = lines[begins[-1]:]
+    solution = {'shift': 0.}
+    for i, line in enumerate(block):
+        if line[0] == 'shift':
+            solution['shift'] = float(line[1])
+        elif line[0] == 'coefficients':
+            values = [float(item[0]) for item in
+                      block[i + 1:i + 1 + int(line[1])]]
+            solution['function'] = FUNCTIONS[int(values[0])]
+            solution['order'] = int(values[1])
+            solution['xmin'] = values[2]
+            solution['xmax'] = values[3]
+            solution['coefficients'] = numpy.array(values[4:])
+    return solution
+
+
+def solution_file(name, num):
+    """Return the database file holding the solution for the comparison
+       lamp spectrum of a slit of a galaxy."""
+    return 'database/id%s/sum/%sc.1d' % (name, num)
+
+
+## Evaluation functions ##
+
+
+def evaluate(solutions, x):
+    """Return the wavelengths at pixels x for each of a list of solutions,
+       one row per solution. Solutions with the same curve type and number
+       of coefficients are evaluated together."""
+    result = numpy.empty((len(solutions), len(x)))
+    groups = {}
+    for i, solution in enumerate(solutions):
+        key = (solution['function'], len(solution['coefficients']))
+        groups.setdefault(key, []).append(i)
+    for (function, size), rows in groups.items():
+        result[rows] = evaluate_group(function,
+                                      [solutions[i] for i in rows], x)
+    return result
+
+
+def evaluate_group(function, solutions, x):
+    """Return the wavelengths at pixels x for solutions that share a curve
+       type and number of coefficients, following the IRAF curfit
+       definitions of each curve."""
+    coefficients = numpy.array([item['coefficients'] for item in solutions])
+    xmin = numpy.array([item['xmin'] for item in solutions])[:, numpy.newaxis]
+    xmax = numpy.array([item['xmax'] for item in solutions])[:, numpy.newaxis]
+    shift = numpy.array([item['shift'] for item in solutions])
+    x = numpy.asarray(x, dtype=float)[numpy.newaxis, :]
+    if function in ('chebyshev', 'legendre'):
+        normal = (2 * x - (xmax + xmin)) / (xmax - xmin)
+        if function == 'chebyshev':
+            value = numpy.polynomial.chebyshev.chebval
+        else:
+            value = numpy.polynomial.legendre.legval
+        waves = value(normal, coefficients.T[:, :, numpy.newaxis],
+                      tensor=False)
+    else:
+        pieces = numpy.array([item['order'] for item in solutions])
+        pieces = pieces[:, numpy.newaxis]
+        scaled = (x - xmin) / (xmax - xmin) * pieces
+        piece = numpy.clip(scaled.astype(int), 0, pieces - 1)
+        a = scaled - piece
+        b = 1. - a
+        if function == 'spline1':
+            basis = [b, a]
+        else:
+            basis = [b ** 3, 1 + b * (3 + b * (3 - 3 * b)),
+                     1 + a * (3 + a * (3 - 3 * a)), a ** 3]
+        rows = numpy.arange(len(solutions))[:, numpy.newaxis]
+        waves = sum([coefficients[rows, piece + k] * item
+                     for k, item in enumerate(basis)])
+    return waves + shift[:, numpy.newaxis]
+
+
+## Resampling functions ##
+
+
+def linear_grid(waves):
+    """Return the starting wavelength and step of the linear grid dispcor
+       chooses for each row of wavelengths: the same number of pixels,
+       covering the same range."""
+    size = waves.shape[1]
+    return waves[:, 0], (waves[:, -1] - waves[:, 0]) / (size - 1)
+
+
+def resample(data, edges, start, step):
+    """Resample spectra onto linear wavelength grids, conserving flux.
+
+       The rows of data are spectra, with the wavelengths of the edges of
+       their pixels in the rows of edges, and each is resampled onto a grid
+       of the same size with its own start and step. The integral of each
+       spectrum is interpolated at the edges of the new pixels and
+       differenced. All rows are done in one interpolation, by moving each
+       row's wavelengths clear of the row before."""
+    (rows, size) = data.shape
+    flip = edges[:, -1] < edges[:, 0]
+    data = numpy.where(flip[:, numpy.newaxis], data[:, ::-1], data)
+    edges = numpy.where(flip[:, numpy.newaxis], edges[:, ::-1], edges)
+    start = numpy.asarray(start)[:, numpy.newaxis]
+    step = numpy.asarray(step)[:, numpy.newaxis]
+    new_edges = start + step * (numpy.arange(size + 1) - 0.5)
+    new_edges = numpy.where(flip[:, numpy.newaxis], new_edges[:, ::-1],
+                            new_edges)
+    total = numpy.zeros((rows, size + 1))
+    total[:, 1:] = numpy.cumsum(data, axis=1)
+    low = min(edges.min(), new_edges.min())
+    offset = (max(edges.max(), new_edges.max()) - low + 1) * \
+        numpy.arange(rows)[:, numpy.newaxis]
+    # each row's cumulative flux runs on from the last row's total
+    base = numpy.zeros((rows, 1))
+    base[1:, 0] = numpy.cumsum(total[:-1, -1])
+    resampled = numpy.interp((new_edges + offset).ravel(),
+                             (edges + offset).ravel(),
+                             (total + base).ravel())
+    resampled = numpy.diff(resampled.reshape(rows, size + 1), axis=1)
+    return numpy.where(flip[:, numpy.newaxis], resampled[:, ::-1],
+                       resampled)
+
+
+## High level functions ##
+
+
+def dispersion_header(header, start, step, reference):
+    """Return the header of a dispersion corrected spectrum, with the
+       linear wavelength WCS dispcor writes and read_wcs expects."""
+    header = header.copy()
+    header['CTYPE1'] = 'LINEAR'
+    header['CRPIX1'] = 1.
+    header['CRVAL1'] = float(start)
+    header['CDELT1'] = float(step)
+    header['CD1_1'] = float(step)
+    header['DC-FLAG'] = 0
+    header['WAT1_001'] = 'wtype=linear label=Wavelength units=angstroms'
+    header['REFSPEC1'] = reference
+    header['DCLOG1'] = 'REFSPEC1 = %s' % reference
+    return header
+
+
+def dispersion_galaxy(name):
+    """Apply dispersion correction to all spectra in a galaxy, the way
+       iraf_high.dispcor_galaxy does, using the solutions of the galaxy
+       the comparison lamp belongs to. Spectra of the same length are
+       corrected together."""
+    use = get_group(name)['galaxy']
+    if not os.path.isdir('%s/disp' % name):
+        os.mkdir('%s/disp' % name)
+    spectra = set(get_object_spectra(name) + get_sky_spectra(name))
+    nums = [zerocount(spectrum) for spectrum in sorted(spectra)]
+    batches = {}
+    for num in nums:
+        (data, header) = load_spectrum('%s/sum/%s.1d.fits' % (name, num))
+        batch = batches.setdefault(len(data), ([], [], [], []))
+        batch[0].append(num)
+        batch[1].append(data)
+        batch[2].append(header)
+        batch[3].append(read_solution(solution_file(use, num)))
+    for size, (nums, data, headers, solutions) in batches.items():
+        edges = evaluate(solutions, numpy.arange(size + 1) + 0.5)
+        centers = evaluate(solutions, numpy.arange(size) + 1.)
+        (start, step) = linear_grid(centers)
+        resampled = resample(numpy.array(data), edges, start, step)
+        for i, num in enumerate(nums):
+            reference = '%s/sum/%sc.1d' % (use, num)
+            write_spectrum('%s/disp/%s.1d.fits' % (name, num), resampled[i],
+                           dispersion_header(headers[i], start[i], step[i],
+                                             reference))
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Extraction of one dimensional spectra from two dimensional images in NumPy,
+in place of apsum.
+
+low level functions: apsum_image, onedspec_header, open_image,
+                     rotate_section, slice_header, write_image
+high level functions: extract_galaxy, extract_slit
+"""
+
+import math
+import os
+import numpy
+import pyfits
+import scipy.ndimage
+from .data import get, get_group
+from .misc import fits_name, parse_section, read_list, zerocount
+from .parallel import pool_map
+from .spectra import write_spectrum
+from .store import fetch, file_digest, product_key, save
+
+
+# header keywords of an image WCS, replaced by a one dimensional one
+WCS_KEYWORDS = ('CTYPE2', 'CRVAL2', 'CRPIX2', 'CDELT2', 'CD1_2', 'CD2_1',
+                'CD2_2', 'LTV1', 'LTV2', 'LTM1_2', 'LTM2_1', 'LTM2_2',
+                'WAT2_001', 'WCSDIM', 'WAT0_001', 'WAT1_001')
+
+# background sample region around the aperture center, as in set_aperture
+BACKGROUND_SAMPLE = ((-10, -6), (6, 10))
+
+# images opened by open_image in this process: file name: (data, header)
+IMAGES = {}
+
+
+## Low level functions ##
+
+
+def apsum_image(data, background='none'):
+    """Sum an image along its spatial axis, the aperture covering every row
+       as the apertures made by set_aperture do.
+
+       The background is 'none', as for apsum by default, or 'average' or
+       'median' to subtract the average or median of the rows in the
+       set_aperture sample region from each column, scaled to the aperture
+       width. If the sample region lies outside the image, no background is
+       subtracted. Several images of the same height may be given as a
+       stack, in which case one spectrum is returned for each."""
+    data = numpy.asarray(data, dtype=float)
+    rows = data.shape[-2]
+    spectrum = data.sum(axis=-2)
+    if background != 'none':
+        center = (rows + 1) / 2.
+        sample = []
+        for (low, high) in BACKGROUND_SAMPLE:
+            first = max(int(numpy.ceil(center + low)) - 1, 0)
+            last = min(int(numpy.floor(center + high)), rows)
+            sample.extend(range(first, last))
+        if not sample:
+            return spectrum
+        values = data[..., sorted(set(sample)), :]
+        if background == 'median':
+            level = numpy.median(values, axis=-2)
+        else:
+            level = values.mean(axis=-2)
+        spectrum -= rows * level
+    return spectrum
+
+
+def onedspec_header(header, rows):
+    """Return a header for a spectrum summed from an image with a given
+       header and number of rows, with the pixel WCS that apsum writes and
+       dispcor expects."""
+    header = header.copy()
+    for keyword in WCS_KEYWORDS:
+        if keyword in header:
+            del header[keyword]
+    header['WCSDIM'] = 1
+    header['CTYPE1'] = 'LINEAR'
+    header['CRVAL1'] = 1.
+    header['CRPIX1'] = 1.
+    header['CDELT1'] = 1.
+    header['CD1_1'] = 1.
+    header['LTM1_1'] = 1.
+    header['WAT0_001'] = 'system=equispec'
+    header['WAT1_001'] = 'wtype=linear label=Pixel'
+    header['APNUM1'] = '1 1 0.50 %.2f' % (rows + 0.5)
+    return header
+
+
+def open_image(fn):
+    """Return the data and header of an image, opened once per process.
+       The data is memory mapped and not converted, so processes reading
+       the same image share its pages and only read the parts they use."""
+    fn = fits_name(fn)
+    if fn not in IMAGES:
+        hdulist = pyfits.open(fn, memmap=True)
+        IMAGES[fn] = (hdulist[0].data, hdulist[0].header)
+    return IMAGES[fn]
+
+
+def rotate_section(data, angle, section):
+    """Return a section of an image as it would be after rotating the whole
+       image with iraf_low.rotate.
+
+       That is, rotated by -angle degrees counter-clockwise about the center
+       of the image with linear interpolation and nearest neighbour boundary
+       extension, the defaults of the IRAF task. Only a box around the
+       section, padded by the reach of the interpolation, is interpolated,
+       so the cost depends on the size of the section and not the image."""
+    (rows, columns) = parse_section(section)
+    (height, width) = data.shape
+    theta = math.radians(-angle)
+    x_center = (width + 1) / 2.
+    y_center = (height + 1) / 2.
+    # one based coordinates of each output pixel, relative to the center
+    y, x = numpy.mgrid[rows, columns] + 1.
+    x -= x_center
+    y -= y_center
+    # zero based coordinates of the input pixels they come from
+    x_in = x_center + x * math.cos(theta) + y * math.sin(theta) - 1
+    y_in = y_center - x * math.sin(theta) + y * math.cos(theta) - 1
+    left = max(int(math.floor(x_in.min())) - 1, 0)
+    right = min(int(math.ceil(x_in.max())) + 2, width)
+    bottom = max(int(math.floor(y_in.min())) - 1, 0)
+    top = min(int(math.ceil(y_in.max())) + 2, height)
+    box = numpy.asarray(data[bottom:top, left:right], dtype=float)
+    return scipy.ndimage.map_coordinates(box, [y_in - bottom, x_in - left],
+                                         order=1, mode='nearest')
+
+
+def slice_header(header, section):
+    """Return the header for a section copied out of an image, with the
+       physical coordinate offsets that imcopy would write."""
+    (rows, columns) = parse_section(section)
+    header = header.copy()
+    header['LTV1'] = -float(columns.start)
+    header['LTV2'] = -float(rows.start)
+    header['LTM1_1'] = 1.
+    header['LTM2_2'] = 1.
+    return header
+
+
+def write_image(fn, data, header):
+    """Write an image to a FITS file, replacing any file already there."""
+    data = numpy.asarray(data, dtype=numpy.float32)
+    pyfits.writeto(fits_name(fn), data, header, clobber=True)
+
+
+## High level functions ##
+
+
+def extract_galaxy(name, keep=False, background='none', jobs=1,
+                   slits=None):
+    """Create one dimensional spectra for a galaxy and its comparison lamp,
+       for every slit or only the given slits, reading the combined image
+       and the lamp image once and rotating, cropping and summing every
+       section in memory. With more than one job, slits are spread across
+       that many worker processes, which share the images through memory
+       mapping.
+
+       Only the spectra in ./name/sum are written, unless keep is set, in
+       which case the rotated and cropped images are also saved in
+       ./name/rot and ./name/slice as rotate_galaxy and imcopy_galaxy would.
+       The comparison lamp image used is the first in its list.
+
+       Lamp spectra are kept in the store, keyed on the content of the lamp
+       image, the angle and the section, so a calibration star that shares
+       its lamp and slits with a galaxy reuses the galaxy's lamp spectra
+       instead of extracting them again."""
+    group = get_group(name)
+    angles = get(name, 'angles')
+    sections = get(name, 'sections')
+    directories = ['sum']
+    if keep:
+        directories.extend(['rot', 'slice'])
+    for directory in directories:
+        if not os.path.isdir('%s/%s' % (name, directory)):
+            os.mkdir('%s/%s' % (name, directory))
+    lamp = fits_name(read_list('lists/%s' % group['lamp'])[0])
+    digest = file_digest(lamp)
+    if slits is None:
+        slits = range(len(sections))
+    work = [(name, i, angles[i], sections[i], lamp, digest, keep, background)
+            for i in slits]
+    pool_map(extract_slit, work, jobs, '%s/tmp' % name)
+    IMAGES.clear()
+
+
+def extract_slit(args):
+    """Create the spectra for one slit of a galaxy, copying the lamp
+       spectrum from the store if it is there. Takes a single tuple of
+       name, slit, angle, section, lamp, lamp digest, keep and background so
+       it can be used with pool_map. The lamp image is only opened if it is
+       needed."""
+    (name, i, angle, section, lamp, digest, keep, background) = args
+    num = zerocount(i)
+    key = product_key('extract', digest, angle, section, background)
+    lampfile = '%s/sum/%sc.1d.fits' % (name, num)
+    sources = {'': '%s/base' % name, 'c': lamp}
+    suffixes = ('', 'c')
+    if not keep and fetch(key, lampfile):
+        suffixes = ('',)
+    for suffix in suffixes:
+        (data, header) = open_image(sources[suffix])
+        strip = rotate_section(data, angle, section)
+        write_spectrum('%s/sum/%s%s.1d.fits' % (name, num, suffix),
+                       apsum_image(strip, background),
+                       onedspec_header(header, len(strip)))
+        if keep:
+            whole = '[1:%s,1:%s]' % (data.shape[1], data.shape[0])
+            write_image('%s/rot/%s%s' % (name, num, suffix),
+                        rotate_section(data, angle, whole), header)
+            write_image('%s/slice/%s%s' % (name, num, suffix), strip,
+                        slice_header(header, section))
+    if 'c' in suffixes:
+        save(key, lampfile)
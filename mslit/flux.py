@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Flux calibration in NumPy, in place of calibrate.
+
+The sensitivity function of a galaxy's calibration star and the extinction
+curve are interpolated onto the wavelengths of every object spectrum of the
+galaxy at once, and applied to all of them together, each with its own air
+mass and exposure time, the defaults of calibrate.
+
+reading functions: extinction_file, read_extinction
+calibration functions: flux_calibrate
+high level functions: flux_galaxy
+"""
+
+from __future__ import with_statement
+import os
+import numpy
+from .data import get_group, get_object_spectra
+from .iraf_low import SESSION
+from .misc import zerocount
+from .spectra import load_spectrum, wavelengths, write_spectrum
+
+
+# the extinction curve used unless the group gives one, that of calibrate
+EXTINCTION = 'onedstds$kpnoextinct.dat'
+
+
+## Reading functions ##
+
+
+def extinction_file(group):
+    """Return the extinction curve to use for a group, taken from its
+       extinction entry if it has one and otherwise EXTINCTION. IRAF paths,
+       such as that of EXTINCTION, are turned into host paths by PyRAF."""
+    fn = group.get('extinction', EXTINCTION)
+    if '$' in fn:
+        fn = SESSION.iraf().osfn(fn)
+    return fn
+
+
+def read_extinction(fn):
+    """Return the wavelengths and extinctions in magnitudes per air mass of
+       an extinction curve, a text file of the two in columns."""
+    with open(fn) as f:
+        rows = [line.split()[:2] for line in f
+                if line.strip() and not line.lstrip().startswith('#')]
+    return numpy.array(rows, dtype=float).T
+
+
+## Calibration functions ##
+
+
+def flux_calibrate(data, waves, step, airmass, exptime, sensitivity,
+                   extinction):
+    """Return spectra corrected for extinction and calibrated to flux per
+       unit wavelength, as calibrate does.
+
+       The rows of data are spectra, with the wavelengths of their pixels in
+       the rows of waves and their wavelength steps, air masses and
+       exposure times in step, airmass and exptime. The sensitivity in
+       magnitudes and the extinction in magnitudes per air mass are each
+       given as a pair of arrays of wavelengths and values, and are
+       interpolated onto every spectrum in one call."""
+    shape = waves.shape
+    sens = numpy.interp(waves.ravel(), *sensitivity).reshape(shape)
+    ext = numpy.interp(waves.ravel(), *extinction).reshape(shape)
+    airmass = numpy.asarray(airmass, dtype=float)[:, numpy.newaxis]
+    scale = (numpy.asarray(exptime, dtype=float) *
+             abs(numpy.asarray(step, dtype=float)))[:, numpy.newaxis]
+    return data * 10 ** (0.4 * (airmass * ext - sens)) / scale
+
+
+## High level functions ##
+
+
+def flux_galaxy(name):
+    """Flux calibrate all object spectra in a galaxy, the way
+       iraf_high.calibrate_galaxy does, with the sensitivity function of
+       its calibration star and the air mass set by setairmass. Spectra of
+       the same length are calibrated together."""
+    group = get_group(name)
+    if not os.path.isdir('%s/cal' % name):
+        os.mkdir('%s/cal' % name)
+    (sens, sens_header) = load_spectrum('%s/sens.fits' % group['star'])
+    sensitivity = (wavelengths(sens_header, len(sens)), sens)
+    extinction = read_extinction(extinction_file(group))
+    batches = {}
+    for spectrum in get_object_spectra(name):
+        num = zerocount(spectrum)
+        (data, header) = load_spectrum('%s/sub/%s.1d.fits' % (name, num))
+        batch = batches.setdefault(len(data), ([], [], []))
+        batch[0].append(num)
+        batch[1].append(data)
+        batch[2].append(header)
+    for size, (nums, data, headers) in batches.items():
+        waves = numpy.array([wavelengths(header, size)
+                             for header in headers])
+        step = [header['CDELT1'] for header in headers]
+        airmass = [header['AIRMASS'] for header in headers]
+        exptime = [header['EXPTIME'] for header in headers]
+        calibrated = flux_calibrate(numpy.array(data), waves, step, airmass,
+                                    exptime, sensitivity, extinction)
+        for i, num in enumerate(nums):
+            header = headers[i].copy()
+            header['EX-FLAG'] = 0
+            header['CA-FLAG'] = 0
+            write_spectrum('%s/cal/%s.1d.fits' % (name, num), calibrated[i],
+                           header)
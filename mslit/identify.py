@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Automatic reidentification of comparison lamp spectra, in place of running
+reidentify by hand for every slit.
+
+One slit identified with identify serves as the reference. Its lines are
+found in the lamp spectrum of every other slit by cross-correlating against
+stretched copies of the reference spectrum, then centroided, fit, and
+written to ./database in the format identify uses, so that dispcor and
+dispersion.dispersion_galaxy can read them.
+
+database functions: read_features, write_solution
+matching functions: centroid, cross_correlate, normalize
+fitting functions: fit_solution
+high level functions: reidentify_galaxy
+"""
+
+from __future__ import with_statement
+import os
+import time
+import numpy
+import numpy.polynomial.chebyshev
+from .data import get
+from .dispersion import read_solution, solution_file
+from .misc import zerocount
+from .spectra import load_spectrum
+
+
+# stretches of the reference spectrum tried when cross-correlating
+STRETCHES = numpy.linspace(0.97, 1.03, 61)
+
+# half width in pixels of the region each line is centroided in
+WINDOW = 4
+
+# slits whose fit has an RMS this many times the median are flagged
+OUTLIER = 3.
+
+
+## Database functions ##
+
+
+def read_features(fn):
+    """Return the pixel positions and wavelengths of the lines identified in
+       an identify database file, leaving out any without a wavelength."""
+    with open(fn) as f:
+        lines = [line.split() for line in f if line.strip()]
+    begins = [i for i, line in enumerate(lines) if line[0] == 'begin']
+    block = lines[begins[-1]:]
+    for i, line in enumerate(block):
+        if line[0] == 'features':
+            features = block[i + 1:i + 1 + int(line[1])]
+            break
+    features = [(float(item[0]), float(item[2])) for item in features
+                if item[2] != 'INDEF']
+    return numpy.array(features).T
+
+
+def write_solution(fn, image, pixels, waves, fit, coefficients, xmin,
+                   xmax):
+    """Write a Chebyshev dispersion solution and the lines it was fit to as
+       an identify database file, replacing any file already there."""
+    lines = ['# %s\n' % time.asctime(),
+             'begin\tidentify %s\n' % image,
+             '\tid\t%s\n' % image,
+             '\ttask\tidentify\n',
+             '\timage\t%s\n' % image,
+             '\tunits\tAngstroms\n',
+             '\tfeatures\t%s\n' % len(pixels)]
+    for pixel, wave, fitted in zip(pixels, waves, fit):
+        lines.append('\t    %10.2f %10.9g %10.9g %5.1f 1 1\n' %
+                     (pixel, fitted, wave, 2. * WINDOW))
+    lines.extend(['\tfunction chebyshev\n',
+                  '\torder\t%s\n' % len(coefficients),
+                  '\tsample\t*\n',
+                  '\tnaverage\t1\n',
+                  '\tniterate\t1\n',
+                  '\tlow_reject\t3.\n',
+                  '\thigh_reject\t3.\n',
+                  '\tgrow\t0.\n',
+                  '\tcoefficients\t%s\n' % (len(coefficients) + 4),
+                  '\t\t1.\n',
+                  '\t\t%s.\n' % len(coefficients),
+                  '\t\t%s\n' % repr(float(xmin)),
+                  '\t\t%s\n' % repr(float(xmax))])
+    lines.extend(['\t\t%s\n' % repr(float(item)) for item in coefficients])
+    lines.append('\n')
+    with open(fn, 'w') as f:
+        f.writelines(lines)
+
+
+## Matching functions ##
+
+
+def centroid(data, positions, iterations=2):
+    """Return the centroids of lines near the given positions in each row of
+       data, one row of positions per row of data, all at once. Each line
+       is centroided over WINDOW pixels either side, above the lowest value
+       there, and the window is moved to the centroid and the centroid
+       found again for a number of iterations. Positions are zero based,
+       and lines whose window runs off the spectrum, or that have nothing
+       above the lowest value, are not a number."""
+    (rows, size) = data.shape
+    offsets = numpy.arange(-WINDOW, WINDOW + 1)
+    row = numpy.arange(rows)[:, numpy.newaxis, numpy.newaxis]
+    for i in range(iterations):
+        positions = numpy.where(numpy.isfinite(positions), positions, -1.)
+        inside = (positions >= WINDOW) & (positions <= size - 1 - WINDOW)
+        index = numpy.round(numpy.where(inside, positions, WINDOW))
+        index = (index[:, :, numpy.newaxis] + offsets).astype(int)
+        values = data[row, index]
+        values = values - values.min(axis=-1)[:, :, numpy.newaxis]
+        weight = values.sum(axis=-1)
+        weight[weight == 0] = numpy.nan
+        positions = numpy.where(inside, (index * values).sum(axis=-1) /
+                                weight, numpy.nan)
+    return positions
+
+
+def cross_correlate(reference, targets):
+    """Return the stretch about the center and the shift in pixels that
+       best match a reference spectrum to each of a number of target
+       spectra, trying every stretch in STRETCHES and every shift at once
+       with Fourier transforms."""
+    size = len(reference)
+    center = (size - 1) / 2.
+    x = numpy.arange(size)
+    stretched = numpy.array([numpy.interp((x - center) / stretch + center,
+                                          x, reference, left=0., right=0.)
+                             for stretch in STRETCHES])
+    length = 2 * size
+    product = (numpy.fft.rfft(targets, length)[:, numpy.newaxis, :] *
+               numpy.conj(numpy.fft.rfft(stretched, length))[numpy.newaxis])
+    correlation = numpy.fft.irfft(product, length)
+    # lags past the middle are negative shifts
+    correlation = numpy.concatenate([correlation[:, :, size:],
+                                     correlation[:, :, :size]], axis=2)
+    best = correlation.reshape(len(targets), -1).argmax(axis=1)
+    (stretch, lag) = numpy.unravel_index(best, correlation.shape[1:])
+    return STRETCHES[stretch], lag - size
+
+
+def normalize(data):
+    """Return spectra with their median subtracted and scaled to a standard
+       deviation of one, so that cross-correlation isn't dominated by the
+       brightest lamp."""
+    data = data - numpy.median(data, axis=-1)[..., numpy.newaxis]
+    scale = data.std(axis=-1)[..., numpy.newaxis]
+    scale[scale == 0] = 1.
+    return data / scale
+
+
+## Fitting functions ##
+
+
+def fit_solution(pixels, waves, order, xmin, xmax, reject=3.):
+    """Fit a Chebyshev curve of a given order to lines at the given pixels,
+       over the range xmin to xmax, rejecting lines more than reject times
+       the RMS from the first fit and fitting again. Return the
+       coefficients, the lines used, and the RMS of the fit. If there are
+       no more lines than the order, before or after rejection, there is no
+       fit, and the coefficients and RMS are None."""
+    use = numpy.isfinite(pixels)
+    for i in range(2):
+        if use.sum() <= order:
+            return None, use, None
+        normal = (2 * pixels[use] - (xmax + xmin)) / (xmax - xmin)
+        coefficients = numpy.polynomial.chebyshev.chebfit(normal, waves[use],
+                                                          order - 1)
+        residuals = numpy.polynomial.chebyshev.chebval(normal, coefficients)
+        residuals -= waves[use]
+        rms = numpy.sqrt(numpy.mean(residuals ** 2))
+        if i == 0:
+            keep = abs(residuals) <= reject * rms
+            use[use.nonzero()[0][~keep]] = False
+    return coefficients, use, rms
+
+
+## High level functions ##
+
+
+def reidentify_galaxy(name, reference=None, order=None):
+    """Identify the lines in the comparison lamp spectrum of every slit of a
+       galaxy that has no dispersion solution yet, from the one for the
+       reference slit, or the first slit with a solution if none is given.
+       The fits are of the order of the reference fit if it is Chebyshev,
+       or of order four otherwise, unless an order is given.
+
+       Print the shift, stretch, lines used and RMS of each fit, marking
+       those with an RMS well above the rest to be checked by hand. Slits
+       with too few lines found to fit are reported and left without a
+       solution."""
+    nums = [zerocount(i) for i in range(len(get(name, 'sections')))]
+    solved = [num for num in nums
+              if os.path.isfile(solution_file(name, num))]
+    if reference is None:
+        if not solved:
+            raise ValueError('no slit of %s has been identified' % name)
+        reference = solved[0]
+    reference = zerocount(int(reference))
+    (pixels, waves) = read_features(solution_file(name, reference))
+    if order is None:
+        solution = read_solution(solution_file(name, reference))
+        order = 4
+        if solution['function'] == 'chebyshev':
+            order = solution['order']
+    todo = [num for num in nums if num not in solved]
+    if not todo:
+        print('%s: every slit has a dispersion solution' % name)
+        return
+    data = numpy.array([load_spectrum('%s/sum/%sc.1d.fits' % (name, num))[0]
+                        for num in [reference] + todo])
+    (stretch, shift) = cross_correlate(normalize(data[0]),
+                                       normalize(data[1:]))
+    center = (data.shape[1] - 1) / 2.
+    # zero based positions of the reference lines in each spectrum
+    guesses = ((pixels - 1 - center)[numpy.newaxis] *
+               stretch[:, numpy.newaxis] + center + shift[:, numpy.newaxis])
+    found = centroid(data[1:], guesses) + 1
+    (xmin, xmax) = (1., float(data.shape[1]))
+    if not os.path.isdir('database/id%s/sum' % name):
+        os.makedirs('database/id%s/sum' % name)
+    results = []
+    for i, num in enumerate(todo):
+        (coefficients, use, rms) = fit_solution(found[i], waves, order,
+                                                xmin, xmax)
+        results.append((num, shift[i], stretch[i], use.sum(), rms))
+        if coefficients is None:
+            continue
+        normal = (2 * found[i][use] - (xmax + xmin)) / (xmax - xmin)
+        fit = numpy.polynomial.chebyshev.chebval(normal, coefficients)
+        write_solution(solution_file(name, num), '%s/sum/%sc.1d' %
+                       (name, num), found[i][use], waves[use], fit,
+                       coefficients, xmin, xmax)
+    fitted = [item[4] for item in results if item[4] is not None]
+    print('%s: reidentified %s of %s slits from %s' %
+          (name, len(fitted), len(todo), reference))
+    for (num, offset, factor, count, rms) in results:
+        if rms is None:
+            print('    %s: shift %d, stretch %.3f, %s of %s lines, too few '
+                  'to fit, not written' %
+                  (num, offset, factor, count, len(waves)))
+            continue
+        flag = ''
+        if rms > OUTLIER * numpy.median(fitted) or count < len(waves) / 2:
+            flag = ', check by hand'
+        print('    %s: shift %d, stretch %.3f, %s of %s lines, RMS %.3f%s' %
+              (num, offset, factor, count, len(waves), rms, flag))
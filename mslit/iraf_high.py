@@ -6,61 +6,95 @@ High level wrappers around IRAF functions.
 
 wrappers: apsum_galaxy, calibrate_galaxy, dispcor_galaxy, fix_galaxy
           imcopy_galaxy, init_galaxy, rotate_galaxy, setairmass_galaxy
-          slice_galaxy, zero_flats
+          slice_galaxy, slice_slit, zero_flats
+misc: fetch_lamps, lamp_keys, remove_images, select_slits, slit_suffixes,
+      write_list
+
+Where a task is run for every slit of a galaxy, the inputs and outputs are
+collected into @lists under ./name/lists so that it is run once per galaxy.
 """
 
+from __future__ import with_statement
 import os
 import os.path
+import pyfits
+from .ccd import ccd_sections, combine_zero_flats, process_galaxy
 from .data import get, get_group, get_groups, get_object_spectra
-from .data import get_sky_spectra, init_data
+from .data import get_sky_spectra, init_data, write
+from .dispersion import dispersion_galaxy
+from .extract import extract_galaxy
+from .flux import flux_galaxy
 from .iraf_low import apsum, calibrate, dispcor, hedit, imcopy, fixpix, ccdproc
-from .iraf_low import rotate, combine, zerocombine, flatcombine
-from .misc import list_convert, namefix, zerocount
+from .iraf_low import rotate, combine, zerocombine, flatcombine, set_aperture
+from .iraf_low import aperture_file
+from .misc import fits_name, list_convert, namefix, read_list, zerocount
+from .parallel import pool_map
+from .spectra import spectrum_path
+from .store import fetch, file_digest, product_key, save
 
 
 ## Higher level IRAF wrappers ##
 
-def apsum_galaxy(name):
-    """Create one dimensional spectra for a galaxy."""
+def apsum_galaxy(name, cached=(), slits=None):
+    """Create one dimensional spectra for a galaxy, or only for the given
+       slits, except for the comparison lamps of the slits in cached."""
     sections = get(name, 'sections')
     if not os.path.isdir('%s/sum' % name):
         os.mkdir('%s/sum' % name)
+    infiles = []
+    outfiles = []
     for i, section in enumerate(sections):
         num = zerocount(i)
-        apsum('%s/slice/%s' % (name, num),
-              '%s/sum/%s.1d' % (name, num), section)
-        apsum('%s/slice/%sc' % (name, num),
-              '%s/sum/%sc.1d' % (name, num), section)
-        namefix('%s/sum/%s.1d' % (name, num))
-        namefix('%s/sum/%sc.1d' % (name, num))
+        for suffix in slit_suffixes(i, cached, slits):
+            infile = '%s/slice/%s%s' % (name, num, suffix)
+            set_aperture(infile, section)
+            infiles.append(infile)
+            outfiles.append('%s/sum/%s%s.1d' % (name, num, suffix))
+    if not infiles:
+        return
+    apsum(write_list(name, 'apsum.in', infiles),
+          write_list(name, 'apsum.out', outfiles))
+    for outfile in outfiles:
+        namefix(outfile)
 
 
-def calibrate_galaxy(name):
-    """Flux calibrate all object spectra in a galaxy."""
+def calibrate_galaxy(name, backend='iraf'):
+    """Flux calibrate all object spectra in a galaxy. With the native
+       backend this is done by flux.flux_galaxy."""
+    if backend == 'native':
+        flux_galaxy(name)
+        return
     group = get_group(name)
     if not os.path.isdir('%s/cal' % name):
         os.mkdir('%s/cal' % name)
     sens = '%s/sens' % group['star']
-    spectra = get_object_spectra(name)
-    for spectrum in spectra:
-        num = zerocount(spectrum)
-        calibrate('%s/sub/%s.1d' % (name, num), sens,
-            '%s/cal/%s.1d' % (name, num))
+    nums = [zerocount(spectrum) for spectrum in get_object_spectra(name)]
+    infiles = ['%s/sub/%s.1d' % (name, num) for num in nums]
+    outfiles = ['%s/cal/%s.1d' % (name, num) for num in nums]
+    calibrate(write_list(name, 'calibrate.in', infiles), sens,
+              write_list(name, 'calibrate.out', outfiles))
 
 
-def dispcor_galaxy(name):
-    """Apply dispersion correction to all spectra in a galaxy."""
+def dispcor_galaxy(name, backend='iraf'):
+    """Apply dispersion correction to all spectra in a galaxy. With the
+       native backend this is done by dispersion.dispersion_galaxy."""
+    if backend == 'native':
+        dispersion_galaxy(name)
+        return
     group = get_group(name)
     use = group['galaxy']
     if not os.path.isdir('%s/disp' % name):
         os.mkdir('%s/disp' % name)
     spectra = set(get_object_spectra(name) + get_sky_spectra(name))
-    for spectrum in spectra:
-        num = zerocount(spectrum)
+    nums = [zerocount(spectrum) for spectrum in sorted(spectra)]
+    for num in nums:
+        # each spectrum has its own reference, so hedit is run separately
         hedit('%s/sum/%s.1d' % (name, num), 'REFSPEC1',
             '%s/sum/%sc.1d' % (use, num))
-        dispcor('%s/sum/%s.1d' % (name, num),
-            '%s/disp/%s.1d' % (name, num))
+    infiles = ['%s/sum/%s.1d' % (name, num) for num in nums]
+    outfiles = ['%s/disp/%s.1d' % (name, num) for num in nums]
+    dispcor(write_list(name, 'dispcor.in', infiles),
+            write_list(name, 'dispcor.out', outfiles))
 
 
 def fix_galaxy(name):
@@ -74,49 +108,120 @@ def fix_galaxy(name):
     fixpix(strlist, 'BPM')
 
 
-def imcopy_galaxy(name):
-    """Create cropped images for all sections in a galaxy."""
+def imcopy_galaxy(name, cached=(), slits=None):
+    """Create cropped images for all sections in a galaxy, or only for the
+       given slits, except for the comparison lamps of the slits in
+       cached."""
     if not os.path.isdir('%s/slice' % name):
         os.mkdir('%s/slice' % name)
     sections = get(name, 'sections')
+    infiles = []
+    outfiles = []
     for i, section in enumerate(sections):
         num = zerocount(i)
-        imcopy('%s/rot/%s%s' % (name, num, section),
-            '%s/slice/%s' % (name, num))
-        imcopy('%s/rot/%sc%s' % (name, num, section),
-            '%s/slice/%sc' % (name, num))
+        for suffix in slit_suffixes(i, cached, slits):
+            infiles.append('%s/rot/%s%s%s' % (name, num, suffix, section))
+            outfiles.append('%s/slice/%s%s' % (name, num, suffix))
+    if not infiles:
+        return
+    imcopy(write_list(name, 'imcopy.in', infiles),
+           write_list(name, 'imcopy.out', outfiles))
+
 
+def init_galaxy(name, backend='iraf', method='sigclip'):
+    """Apply a bad pixel mask, then run ccdproc and combine. With the native
+       backend this is done in one pass by ccd.process_galaxy with the given
+       method, which IRAF doesn't use.
 
-def init_galaxy(name):
-    """Apply a bad pixel mask, then run ccdproc and combine."""
+       The overscan and trim sections are found by ccd.ccd_sections."""
+    if backend == 'native':
+        process_galaxy(name, method)
+        return
     group = get_group(name)
     if not os.path.isdir(name):
         os.mkdir(name)
     fix_galaxy(name)
     with open('lists/%s' % name) as f:
         items = ['%s/%s' % (name, item.strip()) for item in f.readlines()]
-    ccdproc(list_convert(items), zero=group['zero'], flat=group['flat'])
+    header = pyfits.getheader(fits_name(items[0]))
+    (biassec, trimsec) = ccd_sections(group, header)
+    ccdproc(list_convert(items), zero=group['zero'], flat=group['flat'],
+            biassec=biassec, trimsec=trimsec)
     combine(list_convert(items), '%s/base' % name)
 
 
-def rotate_galaxy(name):
-    """Create a rotated image for every spectra in a galaxy."""
+def rotate_galaxy(name, cached=(), slits=None):
+    """Create a rotated image for every spectra in a galaxy, or only for
+       the given slits.
+
+       Slits that share an angle are rotated together, along with their
+       comparison lamp images, except for the slits in cached."""
     group = get_group(name)
     if not os.path.isdir('%s/rot' % name):
         os.mkdir('%s/rot' % name)
     angles = get(name, 'angles')
+    lamps = read_list('lists/%s' % group['lamp'])
+    batches = {}
+    sources = {'': ['%s/base' % name], 'c': lamps}
     for i, angle in enumerate(angles):
         num = zerocount(i)
-        rotate('%s/base' % name, '%s/rot/%s' % (name, num), angle)
-        rotate('@lists/%s' % group['lamp'], '%s/rot/%sc' % (name, num), angle)
+        for suffix in slit_suffixes(i, cached, slits):
+            (infiles, outfiles) = batches.setdefault(angle, ([], []))
+            infiles.extend(sources[suffix])
+            outfiles.append('%s/rot/%s%s' % (name, num, suffix))
+    for i, angle in enumerate(sorted(batches)):
+        (infiles, outfiles) = batches[angle]
+        rotate(write_list(name, 'rotate%s.in' % i, infiles),
+               write_list(name, 'rotate%s.out' % i, outfiles), angle)
+
 
+def slice_galaxy(name, backend='iraf', keep=False, jobs=1):
+    """Create one dimensional spectra for a galaxy. With the native backend
+       this is done in memory by extract_galaxy, which only saves the
+       rotated and cropped images if keep is set. With more than one job,
+       slits are spread across that many worker processes.
 
-def slice_galaxy(name):
-    """Create one dimensional spectra for a galaxy."""
+       Comparison lamp spectra already made for another galaxy with the same
+       lamp, angle and section, such as a calibration star's, are copied
+       from the store instead of being made again. Only spectra already in
+       the store are used, so a star extracted at the same time as its
+       galaxy, as schedule may do, may make its own.
+
+       Only the slits picked by select_slits are extracted, so after a
+       change to name-pixel.yaml only the slits that moved are redone. The
+       backend, lamp images, angle and section of every slit and whether
+       the rotated and cropped images were kept are saved in
+       ./input/name-extract.yaml for select_slits to compare against next
+       time, once every slit has been extracted, so that slits left
+       unfinished by a failed run are redone."""
+    group = get_group(name)
+    lamps = read_list('lists/%s' % group['lamp'])
     init_data(name)
-    rotate_galaxy(name)
-    imcopy_galaxy(name)
-    apsum_galaxy(name)
+    settings = {'backend': backend, 'keep': keep or backend == 'iraf',
+                'lamps': [file_digest(fits_name(lamp)) for lamp in lamps],
+                'slits': [[angle, section] for angle, section in
+                          zip(get(name, 'angles'), get(name, 'sections'))]}
+    slits = select_slits(name, settings)
+    if backend == 'native':
+        extract_galaxy(name, keep, jobs=jobs, slits=slits)
+    else:
+        keys = lamp_keys(name)
+        cached = fetch_lamps(name, keys, slits)
+        remove_images(name, cached, slits)
+        if jobs > 1:
+            for directory in ('rot', 'slice'):
+                if not os.path.isdir('%s/%s' % (name, directory)):
+                    os.mkdir('%s/%s' % (name, directory))
+            work = [(name, i, cached) for i in slits]
+            pool_map(slice_slit, work, jobs, '%s/tmp' % name)
+        else:
+            rotate_galaxy(name, cached, slits)
+            imcopy_galaxy(name, cached, slits)
+            apsum_galaxy(name, cached, slits)
+        for i in slits:
+            if i not in cached:
+                save(keys[i], '%s/sum/%sc.1d.fits' % (name, zerocount(i)))
+    write(name, 'extract', settings)
     # needed for next step
     try:
         os.makedirs('database/id%s/sum' % name)
@@ -124,8 +229,41 @@ def slice_galaxy(name):
         pass
 
 
-def zero_flats():
-    """Combine the zeros and flats for a night, then apply a bad pixel mask."""
+def slice_slit(args):
+    """Rotate, crop and sum the images for one slit of a galaxy, leaving
+       out the comparison lamp if the slit is in cached. Takes a single
+       tuple of name, slit and cached so it can be used with pool_map.
+
+       The aperture file is written to the database of this process and
+       moved to ./database once apsum is done, so that workers can't
+       collide and the files end up where apsum_galaxy leaves them."""
+    (name, i, cached) = args
+    group = get_group(name)
+    angle = get(name, 'angles')[i]
+    section = get(name, 'sections')[i]
+    sources = {'': '%s/base' % name, 'c': '@lists/%s' % group['lamp']}
+    if not os.path.isdir('database'):
+        os.mkdir('database')
+    for suffix in slit_suffixes(i, cached):
+        image = '%s%s' % (zerocount(i), suffix)
+        rotate(sources[suffix], '%s/rot/%s' % (name, image), angle)
+        imcopy('%s/rot/%s%s' % (name, image, section),
+               '%s/slice/%s' % (name, image))
+        infile = '%s/slice/%s' % (name, image)
+        outfile = '%s/sum/%s.1d' % (name, image)
+        apsum(infile, outfile, section)
+        namefix(outfile)
+        aperture = aperture_file(infile)
+        os.rename(aperture, 'database/%s' % os.path.basename(aperture))
+
+
+def zero_flats(backend='iraf', method='sigclip'):
+    """Combine the zeros and flats for a night, then apply a bad pixel mask.
+       With the native backend this is done by ccd.combine_zero_flats with
+       the given method, which IRAF doesn't use."""
+    if backend == 'native':
+        combine_zero_flats(method)
+        return
     groups = get_groups()
     done = []
     for group in groups:
@@ -139,3 +277,111 @@ def zero_flats():
             flatcombine('@lists/%s' % group['flat'], output=group['flat'])
             hedit(group['flat'], 'BPM', group['mask'])
             fixpix(group['flat'], 'BPM')
+
+
+## Misc ##
+
+
+def fetch_lamps(name, keys, slits):
+    """Copy the comparison lamp spectra of the given slits of a galaxy that
+       are in the store into ./name/sum, returning the indices of the slits
+       found."""
+    if not os.path.isdir('%s/sum' % name):
+        os.mkdir('%s/sum' % name)
+    cached = []
+    for i in slits:
+        if fetch(keys[i], '%s/sum/%sc.1d.fits' % (name, zerocount(i))):
+            cached.append(i)
+    return cached
+
+
+def lamp_keys(name):
+    """Return the store key of the comparison lamp spectrum of each slit in
+       a galaxy, made from the lamp images, angle and section."""
+    group = get_group(name)
+    lamps = read_list('lists/%s' % group['lamp'])
+    digests = tuple([file_digest(fits_name(lamp)) for lamp in lamps])
+    return [product_key('apsum', digests, angle, section)
+            for (angle, section) in zip(get(name, 'angles'),
+                                        get(name, 'sections'))]
+
+
+def remove_images(name, cached=(), slits=None):
+    """Remove the rotated and cropped images made for the given slits by an
+       earlier run, since rotate and imcopy won't write over them, except
+       for the comparison lamps of the slits in cached."""
+    for i in range(len(get(name, 'sections'))):
+        for suffix in slit_suffixes(i, cached, slits):
+            for directory in ('rot', 'slice'):
+                fn = '%s/%s/%s%s.fits' % (name, directory, zerocount(i),
+                                          suffix)
+                if os.path.isfile(fn):
+                    os.remove(fn)
+
+
+def select_slits(name, settings):
+    """Return the slits of a galaxy to extract: every slit if the backend
+       or the lamp images differ from the settings saved by the last
+       complete run, or if the rotated and cropped images are to be kept
+       and weren't then; otherwise those whose angle or section differs
+       from the one they were last extracted with, and those whose spectra
+       are missing or older than the combined image. Spectra packed with
+       pack_galaxy are checked through their container. Print what is to
+       be done with each."""
+    base = os.path.getmtime(fits_name('%s/base' % name))
+    sections = get(name, 'sections')
+    previous = {}
+    if os.path.isfile('input/%s-extract.yaml' % name):
+        previous = get(name, 'extract')
+    redo = None
+    if not previous:
+        redo = 'no settings saved by the last run'
+    elif previous.get('backend') != settings['backend']:
+        redo = 'backend changed'
+    elif previous.get('lamps') != settings['lamps']:
+        redo = 'lamp images changed'
+    elif settings['keep'] and not previous.get('keep'):
+        redo = 'intermediate images wanted'
+    extracted = previous.get('slits', [])
+    status = []
+    for i in range(len(sections)):
+        spectra = [spectrum_path('%s/sum/%s%s.1d.fits' %
+                                 (name, zerocount(i), suffix))
+                   for suffix in ('', 'c')]
+        if redo is not None:
+            status.append(redo)
+        elif i >= len(extracted) or extracted[i] != settings['slits'][i]:
+            status.append('angle or section changed')
+        elif not (os.path.isfile(spectra[0]) and os.path.isfile(spectra[1])):
+            status.append('spectra missing')
+        elif os.path.getmtime(spectra[0]) < base:
+            status.append('combined image is newer')
+        else:
+            status.append(None)
+    slits = [i for i, item in enumerate(status) if item is not None]
+    print('%s: extracting %s of %s slits' % (name, len(slits), len(status)))
+    for i, item in enumerate(status):
+        print('    %s: %s' % (zerocount(i), item or 'unchanged'))
+    return slits
+
+
+def slit_suffixes(i, cached, slits=None):
+    """Return the suffixes of the images to make for a slit, leaving out
+       the comparison lamp if it is in cached, or both if slits are given
+       and it isn't among them."""
+    if slits is not None and i not in slits:
+        return ()
+    if i in cached:
+        return ('',)
+    return ('', 'c')
+
+
+def write_list(name, label, items):
+    """Write items to a list file for a galaxy, and return it in the @list
+       notation IRAF accepts."""
+    if not os.path.isdir('%s/lists' % name):
+        os.mkdir('%s/lists' % name)
+    fn = '%s/lists/%s' % (name, label)
+    with open(fn, 'w') as f:
+        f.writelines(['%s\n' % item for item in items])
+    return '@%s' % fn
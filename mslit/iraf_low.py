@@ -4,79 +4,230 @@
 """
 Low level wrappers around IRAF functions.
 
+session: Session, SESSION
 loaders: load_apextract, load_ccdred, load_imgeom, load_kpnoslit,
          load_onedspec
 wrappers: apsum, calibrate, ccdproc, combine, dispcor, flatcombine, fixpix,
           hedit, imcopy, rotate, sarith, scombine, setairmass, zerocombine
-misc: set_aperture
+misc: aperture_file, set_aperture, set_scratch, unpack_inputs
 
 All function wrappers can be passed arbitrary key values which will be
-passed on to the corresponding IRAF function.
+passed on to the corresponding IRAF function. Every wrapper runs its task
+through SESSION, which loads each package and unlearns each task only once
+per process. PyRAF itself is only started when the first task is run.
+Input spectra packed with spectra.pack_galaxy are written back to their
+own files before a task that reads them is run.
 """
 
 from __future__ import with_statement
 import os
 import os.path
-import pyraf.iraf
+import time
+from .misc import fits_name
+from .spectra import load_spectrum, spectrum_path, write_spectrum
+from .trace import INPUT_PARAMS, image_names, traced, tracing
+
+
+## A persistent PyRAF session ##
+
+
+class Session:
+    """Keep track of the state of PyRAF between calls.
+
+       Packages are only loaded the first time they are asked for, and each
+       task is unlearned only the first time it is run. After that, only the
+       parameters set by the previous call of a task are returned to their
+       defaults before the next call. Time spent loading packages and
+       running tasks is accumulated for report.
+
+       PyRAF is slow to start, so it isn't imported until it is needed."""
+
+    def __init__(self):
+        self.module = None      # pyraf.iraf, once it has been imported
+        self.environment = {}   # IRAF environment variables to set
+        self.packages = []      # names of the packages loaded so far
+        self.tasks = {}         # task name: [task, defaults, changed]
+        self.load_time = 0.     # seconds spent loading packages
+        self.task_time = {}     # task name: seconds spent running it
+        self.calls = {}         # task name: number of times it was run
+        self.database = 'database'  # where aperture files are kept
+        self.inherited = None   # task processes of a parent process
+
+    def counts(self):
+        """Return the time and calls counted since the last call, and start
+           counting again from zero, so that a worker process can hand them
+           to its parent to merge."""
+        counts = (self.load_time, self.task_time, self.calls)
+        self.load_time = 0.
+        self.task_time = {}
+        self.calls = {}
+        return counts
+
+    def detach(self):
+        """Stop using the IRAF task processes started by a parent process,
+           in a process forked from it. PyRAF keeps task processes running
+           between calls, and a forked process would otherwise share their
+           pipes with its parent. The parent's processes are kept out of
+           reach rather than shut down, since the parent still uses them.
+           This relies on a private class of PyRAF; without it, release
+           must have been called in the parent before forking."""
+        if self.module is not None:
+            import pyraf.irafexecute
+            if hasattr(pyraf.irafexecute, '_ProcessCache'):
+                self.inherited = pyraf.irafexecute.processCache
+                pyraf.irafexecute.processCache = \
+                    pyraf.irafexecute._ProcessCache()
+
+    def iraf(self):
+        """Return the pyraf.iraf module, starting PyRAF and setting any
+           environment variables waiting on it the first time."""
+        if self.module is None:
+            start = time.time()
+            import pyraf.iraf
+            self.module = pyraf.iraf
+            if self.environment:
+                self.module.set(**self.environment)
+            self.load_time += time.time() - start
+        return self.module
+
+    def load(self, *packages):
+        """Load any of the given packages, in order, not loaded already."""
+        iraf = self.iraf()
+        start = time.time()
+        for package in packages:
+            if package not in self.packages:
+                getattr(iraf, package)(_doprint=0)
+                self.packages.append(package)
+        self.load_time += time.time() - start
+
+    def merge(self, counts):
+        """Add time and calls returned by counts in another process."""
+        (load_time, task_time, calls) = counts
+        self.load_time += load_time
+        for name in task_time:
+            self.task_time[name] = (self.task_time.get(name, 0.) +
+                                    task_time[name])
+            self.calls[name] = self.calls.get(name, 0) + calls[name]
+
+    def prepare(self, name):
+        """Return the task of a given name with its parameters at their
+           defaults, apart from those set by the last call."""
+        if name not in self.tasks:
+            task = getattr(self.iraf(), name)
+            task.unlearn()
+            defaults = dict([(par.name, par.value)
+                             for par in task.getParList()])
+            self.tasks[name] = [task, defaults, []]
+        return self.tasks[name]
+
+    def release(self):
+        """Shut down the IRAF task processes kept running, before forking,
+           if detach can't keep them from a forked process. They are
+           started again when next needed."""
+        if self.module is not None:
+            import pyraf.irafexecute
+            if not hasattr(pyraf.irafexecute, '_ProcessCache'):
+                pyraf.irafexecute.processCache.flush()
+
+    def report(self):
+        """Return a summary of where time was spent."""
+        lines = ['IRAF: %.1fs loading packages, %.1fs running tasks' %
+                 (self.load_time, sum(self.task_time.values()))]
+        for name in sorted(self.task_time):
+            lines.append('    %s: %s calls, %.1fs' %
+                         (name, self.calls[name], self.task_time[name]))
+        return '\n'.join(lines)
+
+    def set_package(self, name, **kwargs):
+        """Set parameters of a package, such as the database of apextract,
+           which its tasks use rather than having their own."""
+        package = getattr(self.iraf(), name)
+        for key, value in kwargs.items():
+            package.setParam(key, value)
+
+    def set(self, **kwargs):
+        """Set IRAF environment variables, now if PyRAF has been started
+           and otherwise as soon as it is."""
+        self.environment.update(kwargs)
+        if self.module is not None:
+            self.module.set(**kwargs)
+
+    def run(self, name, **kwargs):
+        """Run a task with the given parameters."""
+        start = time.time()
+        entry = self.prepare(name)
+        (task, defaults, changed) = entry
+        for key in changed:
+            if key not in kwargs and key in defaults:
+                task.setParam(key, defaults[key])
+        entry[2] = kwargs.keys()
+        unpack_inputs(kwargs)
+        if tracing():
+            traced(name, task, kwargs)
+        else:
+            task(**kwargs)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.task_time[name] = (self.task_time.get(name, 0.) +
+                                time.time() - start)
+
+
+# the session shared by all wrappers in this process
+SESSION = Session()
 
 
 ## Wrappers for loading IRAF packages ##
 
 
 def load_apextract():
-    """Load the apextract package."""
-    pyraf.iraf.noao(_doprint=0)
-    pyraf.iraf.twodspec(_doprint=0)
-    pyraf.iraf.apextract(_doprint=0)
+    """Load the apextract package, with its database where set_aperture
+       writes aperture files."""
+    SESSION.load('noao', 'twodspec', 'apextract')
+    SESSION.set_package('apextract', database=SESSION.database)
 
 
 def load_ccdred():
     """Load the ccdred package."""
-    pyraf.iraf.noao(_doprint=0)
-    pyraf.iraf.imred(_doprint=0)
-    pyraf.iraf.ccdred(_doprint=0)
+    SESSION.load('noao', 'imred', 'ccdred')
 
 
 def load_imgeom():
     """Load the imgeom package."""
-    pyraf.iraf.images(_doprint=0)
-    pyraf.iraf.imgeom(_doprint=0)
+    SESSION.load('images', 'imgeom')
 
 
 def load_kpnoslit():
     """Load the kpnoslit package."""
-    pyraf.iraf.imred(_doprint=0)
-    pyraf.iraf.kpnoslit(_doprint=0)
+    SESSION.load('imred', 'kpnoslit')
 
 
 def load_onedspec():
     """Load the onedspec package."""
-    pyraf.iraf.noao(_doprint=0)
-    pyraf.iraf.onedspec(_doprint=0)
+    SESSION.load('noao', 'onedspec')
 
 
 ## Wrappers around IRAF functions ##
 
 
-def apsum(infiles, outfiles, section, **kwargs):
+def apsum(infiles, outfiles, section=None, **kwargs):
     """Call the apsum function from the apextract package, creating the
-       apeture automatically and setting some defaults appropriately."""
+       apeture automatically if a section is given and setting some
+       defaults appropriately."""
     load_apextract()
-    set_aperture(infiles, section)
+    if section is not None:
+        set_aperture(infiles, section)
     kwargs.setdefault('format', 'onedspec')
     kwargs.setdefault('interactive', 'no')
     kwargs.setdefault('find', 'no')
     kwargs.setdefault('trace', 'no')
     kwargs.setdefault('fittrace', 'no')
-    pyraf.iraf.apsum.unlearn()
-    pyraf.iraf.apsum(input=infiles, output=outfiles, **kwargs)
+    SESSION.run('apsum', input=infiles, output=outfiles, **kwargs)
 
 
 def calibrate(infiles, sens, outfiles, **kwargs):
     """Call the calibrate function from the kpnoslit package."""
     load_kpnoslit()
-    pyraf.iraf.calibrate.unlearn()
-    pyraf.iraf.calibrate(input=infiles, output=outfiles, sens=sens, **kwargs)
+    SESSION.run('calibrate', input=infiles, output=outfiles, sens=sens,
+                **kwargs)
 
 
 def ccdproc(images, **kwargs):
@@ -87,91 +238,84 @@ def ccdproc(images, **kwargs):
     kwargs.setdefault('fixpix', 'no')
     kwargs.setdefault('biassec', '[2049:2080,1:501]')
     kwargs.setdefault('trimsec', '[1:2048,1:501]')
-    pyraf.iraf.ccdproc.unlearn()
-    pyraf.iraf.ccdproc(images=images, **kwargs)
+    SESSION.run('ccdproc', images=images, **kwargs)
 
 
 def combine(infiles, outfiles, **kwargs):
     """Call the combine function from the ccdred package."""
     load_ccdred()
-    pyraf.iraf.combine.unlearn()
-    pyraf.iraf.combine(input=infiles, output=outfiles, **kwargs)
+    SESSION.run('combine', input=infiles, output=outfiles, **kwargs)
 
 
 def dispcor(infiles, outfiles, **kwargs):
     """Call the dispcor function from the onedspec package."""
     load_onedspec()
-    pyraf.iraf.dispcor.unlearn()
-    pyraf.iraf.dispcor(input=infiles, output=outfiles, **kwargs)
+    SESSION.run('dispcor', input=infiles, output=outfiles, **kwargs)
 
 
 def flatcombine(infiles, **kwargs):
     """Call the flatcombine function from the ccdred package."""
     load_ccdred()
     kwargs.setdefault('process', 'no')
-    pyraf.iraf.flatcombine.unlearn()
-    pyraf.iraf.flatcombine(input=infiles, **kwargs)
+    SESSION.run('flatcombine', input=infiles, **kwargs)
 
 
 def fixpix(image, mask, **kwargs):
     """Call the fixpix function from the core IRAF package."""
-    pyraf.iraf.fixpix.unlearn()
-    pyraf.iraf.fixpix(images=image, masks=mask, **kwargs)
+    SESSION.run('fixpix', images=image, masks=mask, **kwargs)
 
 
 def hedit(images, fields, value, **kwargs):
     """Add a field to a file's header using the hedit function."""
     kwargs.setdefault('add', 'yes')
     kwargs.setdefault('verify', 'no')
-    pyraf.iraf.hedit.unlearn()
-    pyraf.iraf.hedit(images=images, fields=fields, value=value, **kwargs)
+    SESSION.run('hedit', images=images, fields=fields, value=value, **kwargs)
 
 
 def imcopy(infiles, outfiles, **kwargs):
     """Call the imcopy function from the core IRAF package."""
-    pyraf.iraf.imcopy.unlearn()
-    pyraf.iraf.imcopy(input=infiles, output=outfiles, **kwargs)
+    SESSION.run('imcopy', input=infiles, output=outfiles, **kwargs)
 
 
 def rotate(infiles, outfiles, angle, **kwargs):
     """Call the rotate function from the imgeom package."""
     load_imgeom()
-    pyraf.iraf.rotate.unlearn()
-    pyraf.iraf.rotate(input=infiles, output=outfiles, rotation=-angle,
-                      **kwargs)
+    SESSION.run('rotate', input=infiles, output=outfiles, rotation=-angle,
+                **kwargs)
 
 
 def sarith(infile1, op, infile2, outfile, **kwargs):
     """Call the sarith function from the onedspec package."""
     load_onedspec()
-    pyraf.iraf.sarith.unlearn()
-    pyraf.iraf.sarith(input1=infile1, op=op, input2=infile2, output=outfile,
-        **kwargs)
+    SESSION.run('sarith', input1=infile1, op=op, input2=infile2,
+                output=outfile, **kwargs)
 
 
 def scombine(infiles, outfiles, **kwargs):
     """Call the scombine function from the onedspec package."""
     load_onedspec()
-    pyraf.iraf.scombine.unlearn()
-    pyraf.iraf.scombine(input=infiles, output=outfiles, **kwargs)
+    SESSION.run('scombine', input=infiles, output=outfiles, **kwargs)
 
 
 def setairmass(images, **kwargs):
     """Call the setairmass function from the kpnoslit package."""
     load_kpnoslit()
-    pyraf.iraf.setairmass.unlearn()
-    pyraf.iraf.setairmass(images=images, **kwargs)
+    SESSION.run('setairmass', images=images, **kwargs)
 
 
 def zerocombine(infiles, **kwargs):
     """Call the zerocombine function from the ccdred package."""
     load_ccdred()
-    pyraf.iraf.zerocombine.unlearn()
-    pyraf.iraf.zerocombine(input=infiles, **kwargs)
+    SESSION.run('zerocombine', input=infiles, **kwargs)
 
 
 ## Misc ##
 
+def aperture_file(infile):
+    """Return the name of the aperture file apsum uses for an image."""
+    return '%s/ap%s' % (SESSION.database, infile.replace('/', '_'))
+
+
 def set_aperture(infile, section):
     """Create an aperture definition file for apsum to use."""
     # section is [left:right,down:up]
@@ -209,7 +353,32 @@ def set_aperture(infile, section):
     tmp.append('\t\t2048.\n')
     tmp.append('\t\t0.\n')
     tmp.append('\n')
-    if not os.path.isdir('./database'):
-        os.mkdir('./database')
-    with open('./database/ap%s' % infile.replace('/', '_'), 'w') as f:
+    if not os.path.isdir(SESSION.database):
+        os.mkdir(SESSION.database)
+    with open(aperture_file(infile), 'w') as f:
         f.writelines(tmp)
+
+
+def unpack_inputs(params):
+    """Write any input spectra of a task that have been packed, and so have
+       no file of their own for IRAF to read, back to their own files."""
+    for key, value in params.items():
+        if key in INPUT_PARAMS:
+            for item in image_names(value):
+                fn = fits_name(item)
+                if spectrum_path(fn) != fn:
+                    write_spectrum(fn, *load_spectrum(fn))
+
+
+def set_scratch(path, apertures=True):
+    """Keep IRAF parameter and temporary files for this process under path,
+       so that processes running tasks at the same time don't collide, and
+       aperture files too if apertures is set. Aperture files kept there
+       must be moved to ./database by the caller before path is removed."""
+    for item in ('uparm', 'tmp'):
+        directory = '%s/%s/' % (os.path.abspath(path), item)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        SESSION.set(**{item: directory})
+    if apertures:
+        SESSION.database = '%s/database' % path
@@ -5,9 +5,11 @@
 Some basic math functions and some convienience functions.
 
 math functions: avg, rms, threshold_round, std
-convienience functions: base, list_convert, remove_nan, zerocount
+convienience functions: base, fits_name, list_convert, parse_section,
+                        read_list, remove_nan, zerocount
 '''
 
+from __future__ import with_statement
 import cmath
 import math
 import os
@@ -85,6 +87,14 @@ def base(location, values, step):
     return step
 
 
+def fits_name(name):
+    """Return the file name of an image given the way IRAF names it, with or
+       without the .fits extension."""
+    if name.endswith('.fits'):
+        return name
+    return '%s.fits' % name
+
+
 def list_convert(pylist):
     """Convert python lists to the strings that IRAF accepts as lists."""
     stringlist = pylist[0]
@@ -98,6 +108,21 @@ def namefix(name):
     os.rename('%s.0001.fits' % name, '%s.fits' % name)
 
 
+def parse_section(section):
+    """Convert an IRAF image section like [x1:x2,y1:y2] into the pair of
+       slices that select it from a NumPy array, rows first."""
+    (columns, rows) = section.strip()[1:-1].split(',')
+    (left, right) = [int(x) for x in columns.split(':')]
+    (down, up) = [int(x) for x in rows.split(':')]
+    return (slice(down - 1, up), slice(left - 1, right))
+
+
+def read_list(fn):
+    """Return the items in an IRAF list file."""
+    with open(fn) as f:
+        return [item.strip() for item in f.readlines() if item.strip()]
+
+
 def remove_nan(*lists):
     """Remove NaNs from one or more lists. If more than one list is given,
        keep the shape of all lists the same."""
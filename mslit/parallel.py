@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Functions for running independent pieces of work in worker processes.
+
+pool functions: pool_map, run_item, worker_init
+"""
+
+import multiprocessing
+import os
+import shutil
+from .iraf_low import SESSION, set_scratch
+
+
+def pool_map(function, items, jobs, scratch):
+    """Apply a function to each item using a pool of worker processes, each
+       with its own scratch directory under scratch, and return the results
+       in order. With one job the items are processed here instead. Time
+       spent in IRAF by the workers is added to SESSION here, so the
+       timing report counts it, summed over the workers."""
+    if jobs <= 1:
+        return [function(item) for item in items]
+    if not os.path.isdir(scratch):
+        os.makedirs(scratch)
+    SESSION.release()
+    pool = multiprocessing.Pool(jobs, worker_init, (scratch,))
+    try:
+        done = pool.map(run_item, [(function, item) for item in items])
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(scratch, ignore_errors=True)
+    results = []
+    for (result, counts) in done:
+        SESSION.merge(counts)
+        results.append(result)
+    return results
+
+
+def run_item(args):
+    """Apply a function to an item in a worker process, and return the
+       result along with the time and calls it took in IRAF. Takes a single
+       tuple of function and item so it can be used with Pool.map."""
+    (function, item) = args
+    result = function(item)
+    return result, SESSION.counts()
+
+
+def worker_init(scratch):
+    """Set up a worker process with its own IRAF task processes and scratch
+       space, and with no time or calls counted yet, since those of the
+       parent are counted there."""
+    SESSION.detach()
+    SESSION.counts()
+    set_scratch('%s/%s' % (scratch, os.getpid()))
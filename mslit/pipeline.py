@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Running the reduction as a pipeline that only redoes work that is out of
+date, in the manner of make.
+
+Each time a stage is run for a galaxy or star, the hashes of the files it
+read and the options it was run with are recorded in
+./state/name-stage.yaml, along with the files it made. A stage is out of
+date if it has never been run, if any of the files it made are missing, or
+if any of its inputs or options have changed since. Stages are checked in
+order, after any earlier stage has been brought up to date, so a change
+propagates only as far as it changes the files made along the way. A galaxy
+or star whose stage fails is reported and left out of the later stages,
+while the others carry on.
+
+stage definitions: STAGES, stage_inputs, stage_outputs
+state: check, hash_inputs, read_state, record
+pipeline: build, stage_names
+"""
+
+from __future__ import with_statement
+import glob
+import os
+import os.path
+import traceback
+import yaml
+from .data import get, get_group, get_groups, get_object_spectra
+from .data import get_sky_spectra
+from .iraf_high import calibrate_galaxy, dispcor_galaxy, init_galaxy
+from .iraf_high import slice_galaxy, zero_flats
+from .misc import fits_name, read_list, zerocount
+from .sky import skies
+from .spectra import spectrum_path
+from .store import file_digest
+from .trace import set_context
+
+
+# the stages of the reduction, in the order they are run
+STAGES = ['zeroflat', 'init', 'extract', 'disp', 'sky', 'calibrate']
+
+# the function that runs each stage
+FUNCTIONS = {'init': init_galaxy, 'extract': slice_galaxy,
+             'disp': dispcor_galaxy, 'sky': skies,
+             'calibrate': calibrate_galaxy}
+
+# the options of each stage that change what it makes, as opposed to how
+# quickly it makes it
+PARAMS = {'zeroflat': ('backend', 'method'), 'init': ('backend', 'method'),
+          'extract': ('backend',), 'disp': ('backend',),
+          'sky': ('solver', 'method', 'backend'), 'calibrate': ('backend',)}
+
+
+## Stage definitions ##
+
+
+def stage_inputs(stage, name):
+    """Return the files that a stage reads for a galaxy or star. For
+       zeroflat, which is run once for a night, name is None."""
+    if stage == 'zeroflat':
+        inputs = ['lists/%s' % group[key] for group in get_groups()
+                  for key in ('zero', 'flat')]
+        inputs.extend([fits_name(item) for fn in inputs
+                       for item in read_list(fn)])
+        return inputs + [group['mask'] for group in get_groups()]
+    group = get_group(name)
+    use = group['galaxy']
+    if stage == 'init':
+        inputs = ['lists/%s' % name, group['mask'],
+                  fits_name(group['zero']), fits_name(group['flat'])]
+        return inputs + [fits_name(item) for item in read_list(inputs[0])]
+    if stage == 'extract':
+        inputs = ['%s/base.fits' % name, 'input/%s.out' % use,
+                  'input/%s-pixel.yaml' % use, 'lists/%s' % group['lamp']]
+        return inputs + [fits_name(item) for item in read_list(inputs[-1])]
+    if stage == 'disp':
+        nums = [zerocount(spectrum) for spectrum in
+                sorted(set(get_object_spectra(name) +
+                           get_sky_spectra(name)))]
+        inputs = ['input/%s-types.yaml' % name]
+        inputs.extend(['%s/sum/%s.1d.fits' % (name, num) for num in nums])
+        inputs.extend(['%s/sum/%sc.1d.fits' % (use, num) for num in nums])
+        return inputs + sorted(glob.glob('database/id%s/sum/*' % use))
+    if stage == 'sky':
+        nums = [zerocount(spectrum) for spectrum in
+                sorted(set(get_object_spectra(name) +
+                           get_sky_spectra(name)))]
+        inputs = ['input/%s-%s.yaml' % (name, item)
+                  for item in ('types', 'sizes', 'sky')]
+        return inputs + ['%s/disp/%s.1d.fits' % (name, num) for num in nums]
+    if stage == 'calibrate':
+        inputs = ['%s/sens.fits' % group['star']]
+        return inputs + ['%s/sub/%s.1d.fits' % (name, zerocount(spectrum))
+                         for spectrum in get_object_spectra(name)]
+
+
+def stage_outputs(stage, name):
+    """Return the files that a stage makes for a galaxy or star."""
+    if stage == 'zeroflat':
+        return [fits_name(group[key]) for group in get_groups()
+                for key in ('zero', 'flat')]
+    if stage == 'init':
+        return ['%s/base.fits' % name]
+    if stage == 'extract':
+        outputs = ['input/%s-sections.yaml' % name]
+        if os.path.isfile(outputs[0]):
+            for i in range(len(get(name, 'sections'))):
+                outputs.extend(['%s/sum/%s%s.1d.fits' % (name, zerocount(i),
+                                                         suffix)
+                                for suffix in ('', 'c')])
+        return outputs
+    if stage == 'disp':
+        spectra = set(get_object_spectra(name) + get_sky_spectra(name))
+        return ['%s/disp/%s.1d.fits' % (name, zerocount(spectrum))
+                for spectrum in sorted(spectra)]
+    if stage == 'sky':
+        return ['%s/sub/%s.1d.fits' % (name, zerocount(spectrum))
+                for spectrum in get_object_spectra(name)]
+    if stage == 'calibrate':
+        return ['%s/cal/%s.1d.fits' % (name, zerocount(spectrum))
+                for spectrum in get_object_spectra(name)]
+
+
+## State ##
+
+
+def check(stage, name, params):
+    """Return the reasons a stage is out of date for a galaxy or star, or an
+       empty list if it is up to date. An input whose modification time and
+       size are as recorded is taken to be unchanged without hashing it. A
+       spectrum packed with pack_galaxy is checked through its container."""
+    state = read_state(stage, name)
+    if state is None:
+        return ['it has not been run']
+    reasons = []
+    for fn in stage_outputs(stage, name):
+        if not os.path.isfile(spectrum_path(fn)):
+            reasons.append('%s is missing' % fn)
+    for key in sorted(set(params) | set(state['params'])):
+        if params.get(key) != state['params'].get(key):
+            reasons.append('%s changed from %s to %s' %
+                           (key, state['params'].get(key), params.get(key)))
+    inputs = stage_inputs(stage, name)
+    for fn in inputs:
+        known = state['inputs'].get(fn)
+        path = spectrum_path(fn)
+        if not os.path.isfile(path):
+            if known is not None:
+                reasons.append('%s was removed' % fn)
+        elif known is None:
+            reasons.append('%s is new' % fn)
+        elif [os.path.getmtime(path), os.path.getsize(path)] != known[1:]:
+            if file_digest(path) != known[0]:
+                reasons.append('%s changed' % fn)
+    for fn in sorted(set(state['inputs']) - set(inputs)):
+        reasons.append('%s is no longer used' % fn)
+    return reasons
+
+
+def hash_inputs(stage, name):
+    """Return the hash, modification time and size of each file a stage
+       reads for a galaxy or star, by file name, for record. Spectra packed
+       with pack_galaxy are hashed through their container."""
+    inputs = {}
+    for fn in stage_inputs(stage, name):
+        path = spectrum_path(fn)
+        if os.path.isfile(path):
+            inputs[fn] = [file_digest(path), os.path.getmtime(path),
+                          os.path.getsize(path)]
+    return inputs
+
+
+def read_state(stage, name):
+    """Return what was recorded the last time a stage was run for a galaxy
+       or star, or None if it never was."""
+    fn = state_file(stage, name)
+    if not os.path.isfile(fn):
+        return None
+    with open(fn) as f:
+        return yaml.load(f)
+
+
+def record(stage, name, params, inputs):
+    """Record the inputs, as returned by hash_inputs before it was run, the
+       options and the outputs of a stage that has just been run for a
+       galaxy or star. Inputs changed while it ran then no longer match,
+       and the stage is run again next time."""
+    if not os.path.isdir('state'):
+        os.mkdir('state')
+    state = {'inputs': inputs, 'params': params,
+             'outputs': stage_outputs(stage, name)}
+    with open(state_file(stage, name), 'w') as f:
+        f.write(yaml.dump(state))
+
+
+def state_file(stage, name):
+    """Return the file the state of a stage for a galaxy or star is kept
+       in."""
+    if name is None:
+        return 'state/%s.yaml' % stage
+    return 'state/%s-%s.yaml' % (name, stage)
+
+
+## Pipeline ##
+
+
+def build(names=None, options=None, explain=False):
+    """Bring every stage up to date for the given galaxies and stars, or
+       for all of them if no names are given. Options for each stage are
+       given in a dictionary by stage name. If explain is set, say why each
+       stage is or isn't being run.
+
+       A galaxy or star whose stage raises an exception has the error
+       printed and is left out of the later stages, and the rest carry on;
+       if zeroflat fails, nothing else is run. Return the names of those
+       that failed, as schedule does."""
+    if options is None:
+        options = {}
+    failed = []
+    for stage in STAGES:
+        stage_options = options.get(stage, {})
+        params = dict([(key, stage_options[key])
+                       for key in PARAMS.get(stage, ()) if key in
+                       stage_options])
+        for name in stage_names(stage, names):
+            if name in failed:
+                continue
+            reasons = check(stage, name, params)
+            label = ' '.join([item for item in (stage, name) if item])
+            if not reasons:
+                if explain:
+                    print('%s: up to date' % label)
+                continue
+            if explain:
+                print('%s: running, %s' % (label, '; '.join(reasons)))
+            set_context(stage=stage, galaxy=name)
+            try:
+                inputs = hash_inputs(stage, name)
+                if stage == 'zeroflat':
+                    zero_flats(**stage_options)
+                else:
+                    FUNCTIONS[stage](name, **stage_options)
+            except Exception:
+                traceback.print_exc()
+                print('%s: failed' % label)
+                if stage == 'zeroflat':
+                    return stage_names('init', names)
+                failed.append(name)
+                continue
+            record(stage, name, params, inputs)
+    return failed
+
+
+def stage_names(stage, names=None):
+    """Return the galaxies and stars a stage is run for, in order, out of
+       the given names or all of them. Only galaxies are calibrated, and the
+       zeroflat stage is run once for the night, with a name of None."""
+    if stage == 'zeroflat':
+        return [None]
+    order = []
+    for group in get_groups():
+        for key in ('galaxy', 'star'):
+            if group[key] not in order:
+                order.append(group[key])
+    if names is not None:
+        order = [name for name in order if name in names]
+    if stage == 'calibrate':
+        galaxies = [group['galaxy'] for group in get_groups()]
+        order = [name for name in order if name in galaxies]
+    return order
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Running a command on the galaxies and stars of a night at the same time.
+
+Each galaxy or star is worked on in its own process, with its own IRAF
+scratch space and with everything it prints sent to a log in ./logs, which
+is printed in one piece when it finishes. Galaxies and stars don't wait on
+each other, since no command run on a star uses what the same command
+makes for its galaxy, but a galaxy is only flux calibrated if its star's
+sensitivity function exists.
+
+scheduling: Job, plan, schedule
+jobs: estimate_memory, fits, print_log, run_job
+"""
+
+from __future__ import with_statement
+import multiprocessing
+import os
+import os.path
+import shutil
+import sys
+import time
+from .data import get_group, get_groups
+from .iraf_low import SESSION, set_scratch
+from .misc import fits_name, read_list
+
+
+# how many times the size of its input images a command holds in memory
+MEMORY_FACTOR = {'init': 3, 'extract': 2}
+
+# seconds to wait between checks on running jobs
+POLL = 0.5
+
+
+## Scheduling ##
+
+
+class Job:
+    """A command to be run on one galaxy or star in its own process.
+
+       The job is not started until every file in requires exists."""
+
+    def __init__(self, command, name, options, requires=()):
+        self.command = command      # the command to run
+        self.name = name            # the galaxy or star to run it on
+        self.options = options      # keyword arguments for the command
+        self.requires = requires    # files that must exist beforehand
+        self.memory = estimate_memory(command, name)
+        self.log = 'logs/%s-%s.log' % (name, command)
+        self.process = None
+
+    def start(self, function):
+        """Start running function(command, name, options) in a new
+           process."""
+        SESSION.release()
+        self.process = multiprocessing.Process(
+            target=run_job, args=(function, self.command, self.name,
+                                  self.options, self.log))
+        self.process.start()
+
+
+def plan(command, options):
+    """Return the jobs needed to run a command on every galaxy and star in
+       the groups file. A star shared by several galaxies is only run once,
+       and stars aren't run at all for commands that only apply to
+       galaxies."""
+    jobs = []
+    names = []
+    for group in get_groups():
+        if command == 'calibrate':
+            requires = (fits_name('%s/sens' % group['star']),)
+        else:
+            requires = ()
+        if group['galaxy'] not in names:
+            names.append(group['galaxy'])
+            jobs.append(Job(command, group['galaxy'], options,
+                            requires=requires))
+        if (command not in ('reidentify', 'calibrate') and
+            group['star'] not in names):
+            names.append(group['star'])
+            jobs.append(Job(command, group['star'], options))
+    return jobs
+
+
+def schedule(jobs, function, workers=1, memory=None):
+    """Run jobs with up to workers of them at once, and if a memory budget
+       in megabytes is given, only as many as are estimated to fit in it,
+       though one job is always allowed to run. Return the names of the jobs
+       that failed or were not run."""
+    names = [job.name for job in jobs]
+    for directory in ('logs', 'tmp'):
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+    waiting = list(jobs)
+    running = []
+    done = {}   # name: whether the job succeeded
+    while waiting or running:
+        for job in running[:]:
+            if not job.process.is_alive():
+                job.process.join()
+                running.remove(job)
+                done[job.name] = job.process.exitcode == 0
+                shutil.rmtree('tmp/%s' % job.name, ignore_errors=True)
+                print_log(job, done[job.name])
+        for job in waiting[:]:
+            missing = [fn for fn in job.requires if not os.path.isfile(fn)]
+            if missing:
+                reason = '%s is missing' % ', '.join(missing)
+            elif fits(job, running, workers, memory):
+                waiting.remove(job)
+                job.start(function)
+                running.append(job)
+                continue
+            else:
+                continue
+            waiting.remove(job)
+            done[job.name] = False
+            print('== %s %s: not run, %s ==' % (job.command, job.name,
+                                                reason))
+        time.sleep(POLL)
+    try:
+        os.rmdir('tmp')
+    except OSError:
+        pass
+    return [name for name in names if not done.get(name)]
+
+
+## Jobs ##
+
+
+def estimate_memory(command, name):
+    """Return a rough estimate in megabytes of the memory needed to run a
+       command on a galaxy or star, from the size of the images it reads.
+       Commands that only work with spectra are counted as needing none."""
+    if command == 'init':
+        images = read_list('lists/%s' % name)
+    elif command == 'extract':
+        images = ['%s/base' % name]
+        images.extend(read_list('lists/%s' % get_group(name)['lamp']))
+    else:
+        return 0
+    images = [fits_name(image) for image in images]
+    size = sum([os.path.getsize(fn) for fn in images if os.path.isfile(fn)])
+    return MEMORY_FACTOR[command] * size / 1e6
+
+
+def fits(job, running, workers, memory):
+    """Return whether a job can be started alongside the running jobs."""
+    if len(running) >= workers:
+        return False
+    if not running or memory is None:
+        return True
+    return sum([item.memory for item in running]) + job.memory <= memory
+
+
+def print_log(job, succeeded):
+    """Print the log of a finished job under a heading."""
+    if succeeded:
+        status = 'done'
+    else:
+        status = 'failed, exit code %s' % job.process.exitcode
+    print('== %s %s: %s ==' % (job.command, job.name, status))
+    if os.path.isfile(job.log):
+        with open(job.log) as f:
+            sys.stdout.write(f.read())
+    sys.stdout.flush()
+
+
+def run_job(function, command, name, options, log):
+    """Run function(command, name, options) with its own IRAF task
+       processes and scratch space, and everything written to standard
+       output and standard error, by Python or by IRAF, sent to log."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    f = open(log, 'w')
+    os.dup2(f.fileno(), 1)
+    os.dup2(f.fileno(), 2)
+    SESSION.detach()
+    # aperture files stay in ./database, since tmp/name is removed after
+    set_scratch('tmp/%s' % name, apertures=False)
+    function(command, name, options)
+    sys.stdout.flush()
+    sys.stderr.flush()
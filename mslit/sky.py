@@ -6,41 +6,60 @@ Functions related to sky subtraction.
 
 high level iraf wrappers: combine_sky_spectra, setairmass_galaxy, skies
                           sky_subtract_galaxy
-low level FITS functions: find_line_peak, find_lines, get_continuum,
-                          get_peak_cont, get_wavelength_location
-functions for solving: get_std_sky, guess_scaling, try_sky
-high level functions: generate_sky, modify_sky, sky_subtract
+low level FITS functions: find_lines, get_sky, get_wavelength_location,
+                          measure_lines
+functions for solving: get_std_sky, guess_scaling, solve_sky, usable_level
+high level functions: generate_sky, modify_sky, report_sky, sky_subtract,
+                      sky_subtract_batch, sky_subtract_spectrum
 """
 
 import os
 import subprocess
-import pyfits
+import numpy
 import scipy.optimize
 from .data import get, get_object_spectra, get_sky_spectra, write
-from .iraf_low import sarith, scombine, setairmass
-from .misc import avg, base, list_convert, rms, std, zerocount
+from .iraf_low import sarith, setairmass
+from .misc import avg, zerocount
+from .parallel import pool_map
+from .spectra import combine, read_spectrum, read_wcs, rebin, stack
+from .spectra import write_spectrum
+from .spectra import sarith as native_sarith
 
 
 # define some atmospheric spectral lines
 LINES = [5893, 5578, 6301, 6365]
 
+# implementations of sarith to use for each backend
+SARITH = {'iraf': sarith, 'native': native_sarith}
+
 
 ## High level IRAF wrappers ##
 
-def combine_sky_spectra(name):
-    """Convert all sky spectra to the same scaling, then combine them."""
+def combine_sky_spectra(name, method='average', keep=False):
+    """Convert all sky spectra to the same scaling, then combine them.
+
+       The sky spectra are read into one array on the wavelength grid of the
+       first, divided by their slit widths and combined with the given
+       method (see spectra.combine). The scaled spectra are only written to
+       ./name/sky if keep is set."""
     sky_list = get_sky_spectra(name)
     sizes = get(name, 'sizes')
     scaled = []
     for spectra in sky_list:
-        scale = sizes[spectra] # scale by the number of pixels arcoss
         num = zerocount(spectra)
-        sarith('%s/disp/%s.1d' % (name, num), '/', scale,
-            '%s/sky/%s.scaled' % (name, num))
-        scaled.append('%s/sky/%s.scaled' % (name, num))
-    if os.path.isfile('%s/sky.1d' % name):
-        os.remove('%s/sky.1d' % name)
-    scombine(list_convert(scaled), '%s/sky.1d' % name)
+        data, header = read_spectrum('%s/disp/%s.1d.fits' % (name, num))
+        if not scaled:
+            sky_header = header
+            size = len(data)
+        scaled.append(rebin(data, header, sky_header, size))
+        if keep:
+            write_spectrum('%s/sky/%s.scaled.fits' % (name, num),
+                           data / sizes[spectra], header)
+    # scale by the number of pixels arcoss
+    scales = numpy.array([sizes[spectra] for spectra in sky_list], dtype=float)
+    scaled = stack(scaled) / scales[:, numpy.newaxis]
+    write_spectrum('%s/sky.1d.fits' % name, combine(scaled, method),
+                   sky_header)
 
 
 def setairmass_galaxy(name):
@@ -50,109 +69,148 @@ def setairmass_galaxy(name):
         num = zerocount(spectrum)
         setairmass('%s/sub/%s.1d' % (name, num))
 
-def skies(name):
+def skies(name, solver='iterative', jobs=1, method='average', keep=False,
+          backend='iraf'):
     """Create a combined sky spectrum, perform sky subtraction, and set
        airmass metadata """
     if not os.path.isdir('%s/sky' % name):
         os.mkdir('%s/sky' % name)
-    combine_sky_spectra(name)
+    combine_sky_spectra(name, method, keep)
     if not os.path.isdir('%s/sub' % name):
         os.mkdir('%s/sub' % name)
-    sky_subtract_galaxy(name)
+    sky_subtract_galaxy(name, solver, jobs, backend)
     setairmass_galaxy(name)
 
 
-def sky_subtract_galaxy(name):
+def sky_subtract_galaxy(name, solver='iterative', jobs=1, backend='iraf'):
     """Remove sky lines from each spectra in a galaxy, making a guess at an
-       appropriate scaling level if none is stored already."""
+       appropriate scaling level if none is stored already.
+
+       The solver is 'iterative' to optimize each spectrum separately,
+       'closed' to solve every spectrum at once with solve_sky, or 'compare'
+       to do the latter and report how it differs from the former. Spectra
+       are handled by a pool of jobs worker processes, and the levels are
+       saved once all are done. A closed form level that isn't positive
+       and finite is left to the iterative optimizer, and a spectrum for
+       which that finds none either is reported and left unsaved, to be
+       solved again next time. The backend is passed on to generate_sky."""
     spectra = get_object_spectra(name)
     sky_levels = get(name, 'sky')
-    for spectrum in spectra:
-        sky_level = sky_levels[spectrum]
-        if not sky_level:
-            sky_level = sky_subtract(name, spectrum)
-        generate_sky(name, spectrum, sky_level)
+    unsolved = [spectrum for spectrum in spectra if not sky_levels[spectrum]]
+    if solver != 'iterative' and unsolved:
+        levels = sky_subtract_batch(name, unsolved, solver == 'compare')
+        for spectrum, sky_level in zip(unsolved, levels):
+            if usable_level(sky_level):
+                sky_levels[spectrum] = sky_level
+    work = [(name, spectrum, sky_levels[spectrum], backend)
+            for spectrum in spectra]
+    levels = pool_map(sky_subtract_spectrum, work, jobs, '%s/tmp' % name)
+    for spectrum, sky_level in zip(spectra, levels):
+        if spectrum not in unsolved or usable_level(sky_level):
+            sky_levels[spectrum] = sky_level
+        else:
+            print('%s %s: no usable sky level found (%s), not saved' %
+                  (name, zerocount(spectrum), sky_level))
+            sky_levels[spectrum] = None
     write(name, 'sky', sky_levels)
 
 
 ## Functions for manipulating the fits data at a low level ##
 
 
-def find_line_peak(data, location, search):
-    """Find the local maximum near a given location. The third option control
-       how far on either side of the expected wavelength location to
-       consider."""
-    search = range(int(location - search), int(location + search))
-    values = [data[i] for i in search]
-    peak_num = search[values.index(max(values))]
-    return peak_num
-
-
 def find_lines(name, num):
     """Find the locations of a number of sky lines in a FITS file."""
     fn = '%s/disp/%s.1d.fits' % (name, num)
-    hdulist = pyfits.open(fn)
-    data = hdulist[0].data
-    header = hdulist[0].header
-    locations = []
-    for line in LINES:
-        line_loc = get_wavelength_location(header, line)
-        locations.append(find_line_peak(data, line_loc, 5))
-    return locations
-
-
-def get_continuum(location, data):
-    """Return the root means square of the continuum values around a
-       location."""
-    upcont_num = base(location, data, 1)
-    downcont_num = base(location, data, -1)
-    data = data.tolist()
-    values = data[upcont_num:(upcont_num + 3)]
-    values.extend(data[(downcont_num - 3):downcont_num])
-    return rms(*values)
-
-
-def get_peak_cont(hdulist, wavelength, search):
-    """Return the maximum value near a given wavelength; also the local
-       continuum level."""
-    data = hdulist[0].data
-    header = hdulist[0].header
-    wavelength_location = get_wavelength_location(header, wavelength)
-    peak_location = find_line_peak(data, wavelength_location, search)
-    peak = data[peak_location]
-    cont = get_continuum(peak_location, data)
-    return peak, cont
-
-
-def get_wavelength_location(headers, wavelength):
-    """Find the location of a given wavelength withing a FITS file."""
-    start = headers['CRVAL1']
-    step = headers['CDELT1']
-    distance = wavelength - start
-    number = round(distance / step)
+    peaks = measure_lines(read_spectrum(fn)[0], read_wcs(fn), LINES)[0]
+    return peaks.tolist()
+
+
+def get_sky(name, header, size):
+    """Return the combined sky spectrum for a galaxy, interpolated onto the
+       wavelength grid of another spectrum."""
+    sky, sky_header = read_spectrum('%s/sky.1d.fits' % name)
+    return rebin(sky, sky_header, header, size)
+
+
+def get_wavelength_location(wcs, wavelength):
+    """Find the location of a given wavelength withing a FITS file, given
+       its starting wavelength and step as returned by read_wcs. Halves
+       are rounded away from zero, as round does."""
+    (start, step) = wcs
+    distance = numpy.asarray(wavelength - start) / step
+    number = numpy.sign(distance) * numpy.floor(abs(distance) + 0.5)
     return number
 
 
+def measure_lines(data, wcs, wavelengths, search=5):
+    """Measure a number of lines in a spectrum, or in each of a list of
+       spectra, which may be of different lengths, all at once.
+
+       The peak of a line is the maximum within search pixels of where its
+       wavelength is expected, the first of them if that is not a number.
+       The continuum is the root mean square of the three pixels after the
+       first and the three before the last, ignoring any that are not a
+       number, since that is what the continuum measured from misc.base
+       has always been. wcs is the starting wavelength and step of the
+       spectrum as returned by read_wcs, or a list of these, one for each
+       spectrum.
+
+       Return arrays of the peak locations, peak values and continuum levels,
+       with one column for each wavelength and, for a list, one row for
+       each spectrum."""
+    single = numpy.ndim(data[0]) == 0
+    if single:
+        data = [data]
+    lengths = numpy.array([len(item) for item in data])[:, numpy.newaxis]
+    stacked = stack([numpy.asarray(item, dtype=float) for item in data])
+    rows = numpy.arange(len(stacked))[:, numpy.newaxis]
+    wcs = numpy.asarray(wcs, dtype=float).reshape(-1, 2)
+    expected = get_wavelength_location((wcs[:, :1], wcs[:, 1:]),
+                                       numpy.asarray(wavelengths, dtype=float))
+    expected = expected.astype(int) + numpy.zeros_like(rows)
+    # the peak is the argmax of a window around each expected location
+    windows = expected[:, :, numpy.newaxis] + numpy.arange(-search, search)
+    windows = numpy.clip(windows, 0, (lengths - 1)[:, :, numpy.newaxis])
+    values = stacked[rows[:, :, numpy.newaxis], windows]
+    choice = numpy.where(numpy.isnan(values), -numpy.inf, values).argmax(2)
+    choice[numpy.isnan(values[:, :, 0])] = 0
+    lines = numpy.arange(len(wavelengths))
+    peaks = windows[rows, lines, choice]
+    ends = numpy.concatenate([stacked[:, 1:4],
+                              stacked[rows, lengths - 4 + numpy.arange(3)]],
+                             1)
+    valid = ~numpy.isnan(ends)
+    count = valid.sum(1).astype(float)
+    count[count == 0] = numpy.nan
+    squares = numpy.where(valid, ends, 0.) ** 2
+    continuum = numpy.sqrt(squares.sum(1) / count)[:, numpy.newaxis]
+    continuum = continuum + numpy.zeros(peaks.shape)
+    results = (peaks, stacked[rows, peaks], continuum)
+    if single:
+        return tuple([item[0] for item in results])
+    return results
+
+
 ## Functions for solving for the proper level of sky subtraction ##
 
 
-def get_std_sky(scale, name, num):
+def get_std_sky(scale, data, sky, locations):
     """Attempt a sky subtraction at a given scaling, and return a metric of
        how good that scaling is.
 
        A proper sky subraction should result in a basically smooth continuum
        left, so this function looks at the standard deviaton of the spectrum
        around spectral lines known to be atmospheric. These values are
-       averaged and return, lower numbers are better."""
-    scale = float(scale)
-    try_sky(scale, name, num)
-    locations = find_lines(name, num)
-    fn = '%s/tmp/%s/%s.1d.fits' % (name, num, scale)
-    hdulist_out = pyfits.open(fn)
+       averaged and return, lower numbers are better.
+
+       The subtraction is done in memory, data and sky being arrays on the
+       same wavelength grid."""
+    residual = data - float(scale) * sky
     deviations = []
     for item in locations:
-        values = hdulist_out[0].data[(item - 50):(item + 50)]
-        deviations.append(std(*values))
+        values = residual[(item - 50):(item + 50)]
+        values = values[~numpy.isnan(values)]
+        deviations.append(values.std())
     return avg(*deviations)
 
 
@@ -165,35 +223,60 @@ def guess_scaling(name, spectrum):
        Average the ratios from each line and return this value."""
     spectra = '%s/disp/%s.1d.fits' % (name, zerocount(spectrum))
     skyname = '%s/sky.1d.fits' % name
-    spectrafits = pyfits.open(spectra)
-    skyfits = pyfits.open(skyname)
-    scalings = []
-    for line in LINES:
-        spec_peak, spec_cont = get_peak_cont(spectrafits, line, 5)
-        sky_peak, sky_cont = get_peak_cont(skyfits, line, 5)
-        scale = ((spec_peak - spec_cont) / (sky_peak - sky_cont))
-        scalings.append(scale)
+    (spec_loc, spec_peak, spec_cont) = measure_lines(
+        read_spectrum(spectra)[0], read_wcs(spectra), LINES)
+    (sky_loc, sky_peak, sky_cont) = measure_lines(
+        read_spectrum(skyname)[0], read_wcs(skyname), LINES)
+    scalings = ((spec_peak - spec_cont) / (sky_peak - sky_cont))
     return avg(*scalings)
 
 
-def try_sky(scale, name, num):
-    """Preform a sky subtraction at a given scaling, saving the result to a
-       temporary location."""
-    sky = '%s/sky.1d' % name
-    scaled_sky = '%s/tmp/%s/%s.sky.1d' % (name, num, scale)
-    in_fn = '%s/disp/%s.1d' % (name, num)
-    out_fn = '%s/tmp/%s/%s.1d' % (name, num, scale)
-    if not (os.path.isfile('%s.fits' % scaled_sky) or
-            os.path.isfile('%s.fits' % out_fn)):
-        sarith(sky, '*', scale, scaled_sky)
-        sarith(in_fn, '-', scaled_sky, out_fn)
+def usable_level(sky_level):
+    """Return whether a sky scaling found by a solver is worth keeping."""
+    return bool(numpy.isfinite(sky_level) and sky_level > 0)
+
+
+def solve_sky(data, sky, locations):
+    """Solve for the sky scaling of many spectra at once.
+
+       Rows of data and sky are object spectra and the sky spectrum on the
+       same grid; rows of locations are the sky line positions in each.
+       Instead of the mean standard deviation used by get_std_sky, this
+       minimizes the mean variance around each line, which is quadratic in
+       the scaling and so has the closed form solution
+       sum(cov(object, sky)) / sum(var(sky)). Spectra without a usable
+       solution come back as NaN."""
+    offsets = numpy.arange(-50, 50)
+    index = numpy.asarray(locations, dtype=int)[:, :, numpy.newaxis] + offsets
+    valid = (index >= 0) & (index < data.shape[1])
+    index = index.clip(0, data.shape[1] - 1)
+    rows = numpy.arange(len(data))[:, numpy.newaxis, numpy.newaxis]
+    objects = data[rows, index]
+    sky_values = sky[rows, index]
+    valid &= ~(numpy.isnan(objects) | numpy.isnan(sky_values))
+    count = valid.sum(axis=2).clip(1, None)
+    objects = numpy.where(valid, objects, 0.)
+    sky_values = numpy.where(valid, sky_values, 0.)
+    object_means = objects.sum(axis=2) / count
+    sky_means = sky_values.sum(axis=2) / count
+    objects -= valid * object_means[:, :, numpy.newaxis]
+    sky_values -= valid * sky_means[:, :, numpy.newaxis]
+    covariance = ((objects * sky_values).sum(axis=2) / count).sum(axis=1)
+    variance = ((sky_values ** 2).sum(axis=2) / count).sum(axis=1)
+    scalings = numpy.empty(len(data))
+    scalings.fill(numpy.nan)
+    solved = variance > 0
+    scalings[solved] = covariance[solved] / variance[solved]
+    return scalings
 
 
 ## Functions wrapping the solvers and providing output ##
 
 
-def generate_sky(name, spectrum, sky_level):
-    """Use sarith to perform sky subtraction at a given scaling level."""
+def generate_sky(name, spectrum, sky_level, backend='iraf'):
+    """Use sarith to perform sky subtraction at a given scaling level. The
+       backend is 'iraf' to use the IRAF task or 'native' to use the NumPy
+       version in spectra."""
     num = zerocount(spectrum)
     in_fn = '%s/disp/%s.1d' % (name, num)
     in_sky = '%s/sky.1d' % name
@@ -201,8 +284,8 @@ def generate_sky(name, spectrum, sky_level):
     out_sky = '%s/sky/%s.sky.1d' % (name, num)
     subprocess.call(['rm', '-f', '%s.fits' % out_fn])
     subprocess.call(['rm', '-f', '%s.fits' % out_sky])
-    sarith(in_sky, '*', sky_level, out_sky)
-    sarith(in_fn, '-', out_sky, out_fn)
+    SARITH[backend](in_sky, '*', sky_level, out_sky)
+    SARITH[backend](in_fn, '-', out_sky, out_fn)
 
 
 def modify_sky(path, name, number, op, value):
@@ -218,14 +301,69 @@ def modify_sky(path, name, number, op, value):
     write(name, 'sky', sky_levels)
     generate_sky(name, number, new_sky_level)
 
+def report_sky(name, spectra, sky_levels):
+    """Print how far each closed form sky scaling is from the scaling found
+       by the iterative optimizer. The two minimize different things, the
+       mean variance and the mean standard deviation around the sky lines,
+       so some difference is expected even when both are right."""
+    print('%s: closed form minimizes the variance around sky lines, '
+          'iterative the standard deviation, so they differ even when both '
+          'converge' % name)
+    for spectrum, sky_level in zip(spectra, sky_levels):
+        iterative = sky_subtract(name, spectrum)
+        print('%s %s: closed %.4f, iterative %.4f, difference %.4f' %
+              (name, zerocount(spectrum), sky_level, iterative,
+               sky_level - iterative))
+
+
 def sky_subtract(name, spectrum):
     """Optimize the get_std_sky function to determine the best level of sky
-       subtraction. Return the value found."""
+       subtraction. Return the value found.
+
+       The object and sky spectra are read once and every trial subtraction
+       is done in memory; nothing is written to disk."""
     num = zerocount(spectrum)
     guess = guess_scaling(name, spectrum)
-    os.mkdir('%s/tmp' % name)
-    os.mkdir('%s/tmp/%s' % (name, num))
+    data, header = read_spectrum('%s/disp/%s.1d.fits' % (name, num))
+    sky = get_sky(name, header, len(data))
+    locations = find_lines(name, num)
     xopt = scipy.optimize.fmin(get_std_sky, guess,
-        args=(name, num), xtol=0.001)
-    subprocess.call(['rm', '-rf', '%s/tmp' % name])
+        args=(data, sky, locations), xtol=0.001)
     return float(xopt)
+
+
+def sky_subtract_batch(name, spectra, compare=False):
+    """Determine the level of sky subtraction for several spectra at once
+       using solve_sky, falling back on guess_scaling for any spectrum it
+       has no valid solution for. Return the values found."""
+    data = []
+    sky = []
+    wcs = []
+    for spectrum in spectra:
+        fn = '%s/disp/%s.1d.fits' % (name, zerocount(spectrum))
+        values, header = read_spectrum(fn)
+        data.append(values)
+        sky.append(get_sky(name, header, len(values)))
+        wcs.append(read_wcs(fn))
+    locations = measure_lines(data, wcs, LINES)[0]
+    scalings = solve_sky(stack(data), stack(sky), locations)
+    sky_levels = []
+    for spectrum, scale in zip(spectra, scalings):
+        if not usable_level(scale):
+            scale = guess_scaling(name, spectrum)
+        sky_levels.append(float(scale))
+    if compare:
+        report_sky(name, spectra, sky_levels)
+    return sky_levels
+
+
+def sky_subtract_spectrum(args):
+    """Perform sky subtraction for one spectrum, first finding the level
+       with sky_subtract if it isn't known. Takes a single tuple of name,
+       spectrum, level and backend so it can be used with pool_map, and
+       returns the level used."""
+    name, spectrum, sky_level, backend = args
+    if not sky_level:
+        sky_level = sky_subtract(name, spectrum)
+    generate_sky(name, spectrum, sky_level, backend)
+    return sky_level
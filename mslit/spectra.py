@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Functions for working with one dimensional spectra as NumPy arrays.
+
+cache: SpectrumCache, CACHE
+containers: container_file, open_container, pack_galaxy, spectrum_path,
+            unpack_galaxy
+readers: load_spectrum, read_spectrum, read_wcs
+writers: write_spectrum
+array functions: combine, stack
+wavelength functions: rebin, wavelengths
+IRAF replacements: sarith
+"""
+
+import glob
+import os
+import os.path
+import numpy
+import pyfits
+from .misc import fits_name
+
+
+# operations understood by sarith
+OPERATIONS = {'+': numpy.add, '-': numpy.subtract, '*': numpy.multiply,
+              '/': numpy.divide}
+
+# the directories of spectra of a galaxy that can be packed into containers
+PACKED = ('sum', 'disp', 'sky', 'sub', 'cal')
+
+# containers opened in this process: path: (mtime, data, table, rows)
+CONTAINERS = {}
+
+
+## Cache ##
+
+
+class SpectrumCache:
+    """A least recently used cache of spectra read from FITS files.
+
+       Entries are keyed on the path, modification time and size of the
+       file, so a file that is rewritten is read again, even within the
+       resolution of its modification time if its size changes. The number
+       of reads served from the cache and from disk are counted in hits and
+       misses."""
+
+    def __init__(self, size=64):
+        self.size = size    # maximum number of spectra kept
+        self.hits = 0       # reads served from the cache
+        self.misses = 0     # reads that went to disk
+        self.entries = {}   # path: (mtime, size, data, header, wcs)
+        self.order = []     # paths, least recently used first
+
+    def clear(self):
+        """Forget every cached spectrum and reset the counters."""
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        self.order = []
+
+    def get(self, fn):
+        """Return the data, header and (CRVAL1, CDELT1) of a spectrum."""
+        path = os.path.abspath(fn)
+        stat = os.stat(spectrum_path(path))
+        entry = self.entries.get(path)
+        if path in self.entries:
+            self.order.remove(path)
+        if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+            self.hits += 1
+        else:
+            self.misses += 1
+            data, header = load_spectrum(path)
+            data.flags.writeable = False
+            wcs = (header['CRVAL1'], header['CDELT1'])
+            entry = (stat.st_mtime, stat.st_size, data, header, wcs)
+            self.entries[path] = entry
+        self.order.append(path)
+        while len(self.order) > self.size:
+            del self.entries[self.order.pop(0)]
+        return entry[2:]
+
+
+# the cache shared by all readers in this process
+CACHE = SpectrumCache()
+
+
+## Containers ##
+
+
+def container_file(fn):
+    """Return the container a spectrum is packed into, and the name of its
+       row there: ./name/disp/000.1d.fits is the row 000.1d of
+       ./name/disp.ms.fits."""
+    (directory, base) = os.path.split(fn)
+    if base.endswith('.fits'):
+        base = base[:-5]
+    return '%s.ms.fits' % directory, base
+
+
+def open_container(fn):
+    """Return the data, table and rows by name of a container, opened memory
+       mapped once per process and again only if it has been rewritten."""
+    path = os.path.abspath(fn)
+    mtime = os.path.getmtime(path)
+    entry = CONTAINERS.get(path)
+    if entry is None or entry[0] != mtime:
+        hdulist = pyfits.open(path, memmap=True)
+        table = hdulist[1].data
+        rows = dict([(item, i) for i, item in enumerate(table.field('NAME'))])
+        entry = (mtime, hdulist[0].data, table, rows)
+        CONTAINERS[path] = entry
+    return entry[1:]
+
+
+def pack_galaxy(name):
+    """Pack the spectra of each stage of a galaxy or star into one container
+       per stage, ./name/stage.ms.fits, and remove the files packed.
+
+       A container is an image with one spectrum per row, padded with NaN,
+       and a table giving the name, length, starting wavelength, step and
+       header of each row. Readers here fall back on the container for a
+       spectrum whose file is missing; IRAF tasks need unpack_galaxy."""
+    for stage in PACKED:
+        files = []
+        for fn in sorted(glob.glob('%s/%s/*.fits' % (name, stage))):
+            if pyfits.getheader(fn).get('NAXIS') == 1:
+                files.append(fn)
+        if not files:
+            continue
+        container = '%s/%s.ms.fits' % (name, stage)
+        if os.path.isfile(container):
+            (data, table, rows) = open_container(container)
+            present = set([os.path.basename(fn)[:-5] for fn in files])
+            for item in sorted(rows):
+                if item not in present:
+                    files.append('%s/%s/%s.fits' % (name, stage, item))
+        (data, headers) = zip(*[load_spectrum(fn) for fn in files])
+        names = [container_file(fn)[1] for fn in files]
+        cards = [header.tostring() for header in headers]
+        columns = [pyfits.Column('NAME', 'A%s' % max(map(len, names)),
+                                 array=names),
+                   pyfits.Column('LENGTH', 'J', array=map(len, data))]
+        for keyword in ('CRVAL1', 'CDELT1'):
+            columns.append(pyfits.Column(keyword, 'D', array=[
+                header.get(keyword, numpy.nan) for header in headers]))
+        columns.append(pyfits.Column('HEADER', 'A%s' % max(map(len, cards)),
+                                     array=cards))
+        image = numpy.asarray(stack(data), dtype=numpy.float32)
+        hdulist = pyfits.HDUList([pyfits.PrimaryHDU(image),
+                                  pyfits.new_table(columns)])
+        hdulist.writeto('%s.tmp' % container, clobber=True)
+        os.rename('%s.tmp' % container, container)
+        for fn in files:
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+
+def spectrum_path(fn):
+    """Return the file a spectrum is read from: its own file if there is
+       one, and otherwise the container it is packed into, if any."""
+    if not os.path.isfile(fn):
+        (container, item) = container_file(fn)
+        if (os.path.isfile(container) and
+            item in open_container(container)[2]):
+            return container
+    return fn
+
+
+def unpack_galaxy(name):
+    """Write every spectrum packed by pack_galaxy back to its own file, for
+       IRAF tasks to use, leaving files that exist already alone. The
+       containers are kept."""
+    for stage in PACKED:
+        container = '%s/%s.ms.fits' % (name, stage)
+        if not os.path.isfile(container):
+            continue
+        if not os.path.isdir('%s/%s' % (name, stage)):
+            os.mkdir('%s/%s' % (name, stage))
+        for item in sorted(open_container(container)[2]):
+            fn = '%s/%s/%s.fits' % (name, stage, item)
+            if not os.path.isfile(fn):
+                write_spectrum(fn, *load_spectrum(fn))
+
+
+## Readers ##
+
+
+def load_spectrum(fn):
+    """Read a one dimensional spectrum from a FITS file, returning the data
+       as a float array along with the header. If the file is missing, the
+       spectrum is read from the container it was packed into."""
+    if spectrum_path(fn) != fn:
+        (container, item) = container_file(fn)
+        (data, table, rows) = open_container(container)
+        i = rows[item]
+        header = pyfits.Header.fromstring(table.field('HEADER')[i])
+        return (numpy.array(data[i, :table.field('LENGTH')[i]],
+                            dtype=float), header)
+    hdulist = pyfits.open(fn)
+    data = numpy.array(hdulist[0].data, dtype=float).ravel()
+    header = hdulist[0].header
+    hdulist.close()
+    return data, header
+
+
+def read_spectrum(fn):
+    """Return the data and header of a spectrum through the cache. The data
+       is read only, since it is shared with every other reader."""
+    data, header, wcs = CACHE.get(fn)
+    return data, header
+
+
+def read_wcs(fn):
+    """Return the starting wavelength and step of a spectrum through the
+       cache."""
+    data, header, wcs = CACHE.get(fn)
+    return wcs
+
+
+## Writers ##
+
+
+def write_spectrum(fn, data, header):
+    """Write a one dimensional spectrum to a FITS file, replacing any file
+       already there."""
+    data = numpy.asarray(data, dtype=numpy.float32)
+    pyfits.writeto(fn, data, header.copy(), clobber=True)
+
+
+## Array functions ##
+
+
+def combine(stacked, method='average', sigma=3., iterations=3):
+    """Combine the rows of a two dimensional array, ignoring NaN. The method
+       is one of 'average', 'median' or 'sigclip', the last being an average
+       after iteratively rejecting points more than sigma standard
+       deviations from it."""
+    values = numpy.ma.masked_invalid(stacked)
+    if method == 'median':
+        combined = numpy.ma.median(values, axis=0)
+    elif method == 'sigclip':
+        for i in range(iterations):
+            deviation = abs(values - values.mean(axis=0))
+            values = numpy.ma.masked_where(
+                deviation > sigma * values.std(axis=0), values)
+        combined = values.mean(axis=0)
+    else:
+        combined = values.mean(axis=0)
+    return numpy.ma.filled(combined.astype(float), numpy.nan)
+
+
+def stack(arrays):
+    """Stack one dimensional arrays of possibly different lengths into the
+       rows of a two dimensional array, padding the short rows with NaN."""
+    width = max([len(item) for item in arrays])
+    stacked = numpy.empty((len(arrays), width))
+    stacked.fill(numpy.nan)
+    for i, item in enumerate(arrays):
+        stacked[i, :len(item)] = item
+    return stacked
+
+
+## Wavelength functions ##
+
+
+def rebin(data, header, new_header, size):
+    """Interpolate a spectrum onto the wavelength grid described by another
+       header. Points outside the original wavelength range are NaN."""
+    old = wavelengths(header, len(data))
+    new = wavelengths(new_header, size)
+    return numpy.interp(new, old, data, left=numpy.nan, right=numpy.nan)
+
+
+def wavelengths(header, size):
+    """Return the wavelength of each pixel in a linear dispersion
+       spectrum."""
+    start = header['CRVAL1']
+    step = header['CDELT1']
+    return start + step * numpy.arange(size)
+
+
+## IRAF replacements ##
+
+
+def sarith(infile1, op, infile2, outfile):
+    """Do arithmetic between a spectrum and either a number or a second
+       spectrum, a replacement for the sarith function from the onedspec
+       package taking the same arguments.
+
+       With two spectra, the output covers the wavelengths where they
+       overlap, on the grid of the first, with the second interpolated
+       linearly onto it, and a ValueError is raised if they don't overlap.
+       The header is that of the first spectrum.
+
+       Only when both spectra are on the same wavelength grid does the
+       result agree with IRAF to single precision rounding. That isn't so
+       for spectra dispersion corrected slit by slit, which each have their
+       own grid unless dispcor was told to put them all on one. IRAF then
+       rebins the second spectrum with its own interpolator (poly5 by
+       default), so values near sharp lines differ by up to the difference
+       between the two interpolations."""
+    data, header = read_spectrum(fits_name(infile1))
+    if isinstance(infile2, str):
+        other, other_header = read_spectrum(fits_name(infile2))
+        waves = wavelengths(header, len(data))
+        other_waves = wavelengths(other_header, len(other))
+        slack = 1e-6 * abs(header['CDELT1'])
+        overlap = ((waves >= other_waves.min() - slack) &
+                   (waves <= other_waves.max() + slack)).nonzero()[0]
+        if not len(overlap):
+            raise ValueError('%s and %s do not overlap in wavelength' %
+                             (infile1, infile2))
+        header = header.copy()
+        header['CRVAL1'] = waves[overlap[0]]
+        data = data[overlap[0]:overlap[-1] + 1]
+        other = numpy.interp(waves[overlap[0]:overlap[-1] + 1],
+                             other_waves, other)
+    else:
+        other = float(infile2)
+    write_spectrum(fits_name(outfile), OPERATIONS[op](data, other), header)
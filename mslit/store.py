@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A content addressed store for data products.
+
+Products are saved in ./cache under a key made from a hash of everything that
+went into making them, so that work which is identical between galaxies, such
+as extracting the same comparison lamp at the same angle and section for a
+galaxy and its calibration star, is only done once.
+
+hashing: file_digest, product_key
+store functions: fetch, save
+"""
+
+import hashlib
+import os
+import os.path
+import shutil
+
+
+# where products are kept, relative to the base directory
+STORE = 'cache'
+
+# digests of files already hashed: path: (mtime, size, digest)
+DIGESTS = {}
+
+
+## Hashing ##
+
+
+def file_digest(fn):
+    """Return a hash of the contents of a file, only reading it again if its
+       modification time or size has changed."""
+    path = os.path.abspath(fn)
+    stat = os.stat(path)
+    known = DIGESTS.get(path)
+    if known is not None and known[:2] == (stat.st_mtime, stat.st_size):
+        return known[2]
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            digest.update(block)
+    finally:
+        f.close()
+    DIGESTS[path] = (stat.st_mtime, stat.st_size, digest.hexdigest())
+    return DIGESTS[path][2]
+
+
+def product_key(*parts):
+    """Return the key for a product made from the given parts, which should
+       include file digests rather than file names for any inputs."""
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+## Store functions ##
+
+
+def fetch(key, fn):
+    """Copy the product with a given key to fn. Return whether it was in the
+       store."""
+    stored = '%s/%s.fits' % (STORE, key)
+    if not os.path.isfile(stored):
+        return False
+    shutil.copyfile(stored, fn)
+    return True
+
+
+def save(key, fn):
+    """Save a copy of the file fn in the store under a given key. Other
+       processes may be saving to the store at the same time, so the copy is
+       only put in place once it is complete."""
+    try:
+        os.mkdir(STORE)
+    except OSError:
+        pass
+    stored = '%s/%s.fits' % (STORE, key)
+    partial = '%s.%s' % (stored, os.getpid())
+    shutil.copyfile(fn, partial)
+    os.rename(partial, stored)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tracing and timing of the IRAF tasks run by the pipeline.
+
+When tracing is on, every task run through iraf_low records one JSON object
+per line in the trace file: the task, its parameters, the files it read and
+wrote with their sizes, wall clock time, and the stage and galaxy being
+worked on. When tracing is off the only cost is a check of tracing().
+
+tracing: set_context, start_trace, stop_trace, traced, tracing
+summaries: read_trace, summarize
+misc: expand_files, image_names
+"""
+
+from __future__ import with_statement
+import json
+import os
+import os.path
+import time
+
+
+# parameters of IRAF tasks that name files read or written
+INPUT_PARAMS = ('input', 'input1', 'input2', 'images', 'sens')
+OUTPUT_PARAMS = ('output', 'images')
+
+# the open trace file, None when tracing is off
+TRACE = None
+
+# the stage and galaxy of the work being done
+CONTEXT = {'stage': None, 'galaxy': None}
+
+
+## Tracing ##
+
+
+def set_context(**kwargs):
+    """Set the stage or galaxy recorded with each traced task."""
+    CONTEXT.update(kwargs)
+
+
+def start_trace(fn):
+    """Start appending trace records to a file."""
+    global TRACE
+    stop_trace()
+    TRACE = open(fn, 'a')
+
+
+def stop_trace():
+    """Stop tracing, closing the trace file."""
+    global TRACE
+    if TRACE is not None:
+        TRACE.close()
+        TRACE = None
+
+
+def traced(name, task, params):
+    """Run an IRAF task with the given parameters and record it in the
+       trace file."""
+    inputs = []
+    outputs = []
+    for key, value in params.items():
+        if key in INPUT_PARAMS:
+            inputs.extend(expand_files(value))
+        if key in OUTPUT_PARAMS:
+            outputs.append(value)
+    bytes_read = sum([os.path.getsize(fn) for fn in inputs])
+    start = time.time()
+    task(**params)
+    wall = time.time() - start
+    outputs = sum([expand_files(value) for value in outputs], [])
+    record = {'task': name, 'stage': CONTEXT['stage'],
+              'galaxy': CONTEXT['galaxy'], 'time': start,
+              'params': dict([(key, str(value))
+                              for key, value in params.items()]),
+              'inputs': inputs, 'outputs': outputs,
+              'bytes_read': bytes_read,
+              'bytes_written': sum([os.path.getsize(fn) for fn in outputs]),
+              'wall': wall}
+    TRACE.write('%s\n' % json.dumps(record))
+    TRACE.flush()
+
+
+def tracing():
+    """Return whether tracing is on."""
+    return TRACE is not None
+
+
+## Summaries ##
+
+
+def read_trace(fn):
+    """Return the records in a trace file."""
+    with open(fn) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(fn, keys=('task', 'stage', 'galaxy')):
+    """Return a summary of a trace file, with the calls, time and data
+       totalled by each of the given record fields."""
+    records = read_trace(fn)
+    lines = []
+    for key in keys:
+        totals = {}
+        for record in records:
+            total = totals.setdefault(record[key], [0, 0., 0, 0])
+            total[0] += 1
+            total[1] += record['wall']
+            total[2] += record['bytes_read']
+            total[3] += record['bytes_written']
+        lines.append('By %s:' % key)
+        for value in sorted(totals, key=lambda x: -totals[x][1]):
+            (calls, wall, read, written) = totals[value]
+            lines.append('    %-16s %6d calls %9.1fs wall %9.1fMB read '
+                         '%9.1fMB written' %
+                         (value, calls, wall, read / 1e6, written / 1e6))
+    return '\n'.join(lines)
+
+
+## Misc ##
+
+
+def expand_files(value):
+    """Return the existing FITS files named by an IRAF image parameter."""
+    files = []
+    for item in image_names(value):
+        for fn in (item, '%s.fits' % item):
+            if os.path.isfile(fn):
+                files.append(fn)
+                break
+    return files
+
+
+def image_names(value):
+    """Return the images named by an IRAF image parameter, which may be an
+       @list, a comma separated list, or images with a section, without
+       their sections."""
+    if not isinstance(value, str):
+        return []
+    names = []
+    for item in value.split(','):
+        item = item.strip()
+        if item.startswith('@'):
+            if os.path.isfile(item[1:]):
+                with open(item[1:]) as f:
+                    names.extend([line.strip() for line in f])
+        elif item:
+            names.append(item)
+    return [item.split('[')[0] for item in names]
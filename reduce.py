@@ -9,10 +9,15 @@ Commands:
 zeroflat: combine any zero and flat images for a night
 init: initialize a galaxy or star
 extract: extract one dimensional spectra from a galaxy or star
+reidentify: identify the comparison lamp lines of a galaxy from one slit
 disp: apply dispersion correction to a galaxy or star
 sky: perform sky subtraction for a galaxy or star
 calibrate: flux calibrate a galaxy
+run: bring every step up to date, redoing only what has changed
+pack: keep the spectra of each step of a galaxy or star in one file
+unpack: write packed spectra back to their own files for IRAF
 analyze: produce graphs and tables of measured data
+trace: summarize a trace file written with --trace
 """
 
 
@@ -20,28 +25,96 @@ import argparse
 import os
 from mslit import analyze, calibrate_galaxy, dispcor_galaxy, get_groups
 from mslit import init_galaxy, slice_galaxy, skies, zero_flats
+from mslit.identify import reidentify_galaxy
+from mslit.data import CACHE as METADATA
+from mslit.iraf_low import SESSION
+from mslit.pipeline import STAGES, build
+from mslit.schedule import plan, schedule
+from mslit.spectra import CACHE as SPECTRA
+from mslit.spectra import pack_galaxy, unpack_galaxy
+from mslit.trace import set_context, start_trace, stop_trace, summarize
 
 
-def main(command, path, name):
-    """Execute commands from the command line."""
-    commands = {'init': init_galaxy, 'extract': slice_galaxy,
-                'disp': dispcor_galaxy,
-                'sky': skies, 'calibrate': calibrate_galaxy}
+COMMANDS = {'init': init_galaxy, 'extract': slice_galaxy,
+            'reidentify': reidentify_galaxy, 'disp': dispcor_galaxy,
+            'sky': skies, 'calibrate': calibrate_galaxy, 'pack': pack_galaxy,
+            'unpack': unpack_galaxy}
+
+
+def main(command, path, name, options=None, timing=False, trace=None,
+         workers=1, memory=None):
+    """Execute commands from the command line. Any options are passed on to
+       the command as keyword arguments. If timing is set, report where
+       time was spent in IRAF and what caching saved afterwards. If a trace
+       file is given, IRAF tasks are recorded in it, or for the trace
+       command, summarized from it. With more than one worker, all
+       galaxies and stars are worked on that many at a time, within a
+       memory budget in megabytes if one is given."""
+    if options is None:
+        options = {}
+    if trace is not None:
+        trace = os.path.abspath(trace)
     os.chdir(path)
+    if command == 'trace':
+        print(summarize(trace or 'trace.jsonl'))
+        return
+    if trace is not None:
+        start_trace(trace)
     if command == 'zeroflat':
-        zero_flats()
+        set_context(stage=command, galaxy=None)
+        zero_flats(**options)
     elif command == 'analyze':
         analyze()
+    elif command == 'run':
+        if name == 'all':
+            failed = build(**options)
+        else:
+            failed = build(name.split(','), **options)
+        if failed:
+            print('Failed or not run: %s' % ', '.join(failed))
+    elif name == 'all' and workers > 1:
+        function = run
+        if timing:
+            function = run_timed
+        failed = schedule(plan(command, options), function, workers, memory)
+        if failed:
+            print('Failed or not run: %s' % ', '.join(failed))
     elif name == 'all':
         groups = get_groups()
         for group in groups:
-            commands[command](group['galaxy'])
-            if command != 'calibrate':
-                commands[command](group['star'])
+            run(command, group['galaxy'], options)
+            if command not in ('reidentify', 'calibrate'):
+                run(command, group['star'], options)
     else:
         names = name.split(',')
         for name in names:
-            commands[command](name)
+            run(command, name, options)
+    stop_trace()
+    if timing:
+        print(report())
+
+
+def report():
+    """Return the timing report: where time was spent in IRAF, and how many
+       reads of spectra and metadata were saved by caching."""
+    return '\n'.join([SESSION.report(),
+                      'Spectra: %s read from disk, %s from the cache' %
+                      (SPECTRA.misses, SPECTRA.hits),
+                      'Metadata: %s files parsed, %s parses avoided' %
+                      (METADATA.parses, METADATA.avoided)])
+
+
+def run(command, name, options):
+    """Run a command on a single galaxy or star."""
+    set_context(stage=command, galaxy=name)
+    COMMANDS[command](name, **options)
+
+
+def run_timed(command, name, options):
+    """Run a command on a single galaxy or star in a scheduled job with
+       --timing, where the timing report goes to the log of the job."""
+    run(command, name, options)
+    print(report())
 
 
 def parse_args():
@@ -55,19 +128,107 @@ Commands:
 zeroflat: combine any zero and flat images for a night
 init: initialize a galaxy or star
 extract: extract one dimensional spectra from a galaxy or star
+reidentify: identify the comparison lamp lines of a galaxy from one slit
 disp: apply dispersion correction to a galaxy or star
 sky: perform sky subtraction for a galaxy or star
 calibrate: flux calibrate a galaxy
-analyze: produce graphs and tables of measured data""")
+run: bring every step up to date, redoing only what has changed
+pack: keep the spectra of each step of a galaxy or star in one file
+unpack: write packed spectra back to their own files for IRAF
+analyze: produce graphs and tables of measured data
+trace: summarize a trace file written with --trace""")
     parser.add_argument('command', help="command to run",
-                        choices=['zeroflat', 'init', 'extract', 'disp', 'sky',
-                                 'calibrate', 'analyze'])
+                        choices=['zeroflat', 'init', 'extract', 'reidentify',
+                                 'disp', 'sky', 'calibrate', 'run', 'pack',
+                                 'unpack', 'analyze', 'trace'])
     parser.add_argument('path', help="path to the set of files")
     parser.add_argument('-n', '--name', default="all",
                         help="name of the galaxy or star to act on (default: "
                              "%(default)s)")
+    parser.add_argument('--sky-solver', default='iterative',
+                        choices=['iterative', 'closed', 'compare'],
+                        help="how sky scalings are found by the sky command: "
+                             "optimize each spectrum, solve them all in "
+                             "closed form, or solve in closed form and "
+                             "report the difference, which includes that "
+                             "between minimizing variance and standard "
+                             "deviation (default: %(default)s)")
+    parser.add_argument('--sky-combine', default='average',
+                        choices=['average', 'median', 'sigclip'],
+                        help="how the sky command combines sky spectra "
+                             "(default: %(default)s)")
+    parser.add_argument('--ccd-combine', default='sigclip',
+                        choices=['average', 'median', 'sigclip'],
+                        help="how zero and flat images, and the images of "
+                             "a galaxy or star, are combined by the zeroflat "
+                             "and init commands with the native backend; "
+                             "the IRAF backend uses the defaults of "
+                             "zerocombine, flatcombine and combine instead, "
+                             "which differ (default: %(default)s)")
+    parser.add_argument('--reference', metavar='NUM',
+                        help="slit whose identified lines the reidentify "
+                             "command starts from (default: the first slit "
+                             "with a dispersion solution)")
+    parser.add_argument('-b', '--backend', default='iraf',
+                        choices=['iraf', 'native'],
+                        help="use IRAF tasks, or NumPy replacements where "
+                             "they exist (default: %(default)s)")
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help="keep intermediate files for inspection")
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help="number of worker processes to use for the "
+                             "extract and sky commands (default: "
+                             "%(default)s)")
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help="number of galaxies and stars to work on at "
+                             "once when no name is given (default: "
+                             "%(default)s)")
+    parser.add_argument('--memory', type=float, metavar='MB',
+                        help="with --workers, only start another galaxy or "
+                             "star if its estimated memory use fits in MB")
+    parser.add_argument('--explain', action='store_true',
+                        help="for the run command, say why each step is or "
+                             "isn't being redone")
+    parser.add_argument('-t', '--timing', action='store_true',
+                        help="report time spent loading IRAF packages and "
+                             "running IRAF tasks, and reads saved by caching")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="record every IRAF task run in FILE; for the "
+                             "trace command, the file to summarize (default: "
+                             "trace.jsonl under path)")
     args = vars(parser.parse_args())
-    return (args['command'], args['path'], args['name'])
+    if args['command'] == 'run':
+        options = {'explain': args['explain'],
+                   'options': dict([(command, command_options(command, args))
+                                    for command in STAGES])}
+    else:
+        options = command_options(args['command'], args)
+    return (args['command'], args['path'], args['name'], options,
+            args['timing'], args['trace'], args['workers'], args['memory'])
+
+
+def command_options(command, args):
+    """Return the options given on the command line that are passed on to a
+       command."""
+    options = {}
+    if command in ('zeroflat', 'init'):
+        options['backend'] = args['backend']
+        options['method'] = args['ccd_combine']
+    elif command == 'sky':
+        options['solver'] = args['sky_solver']
+        options['jobs'] = args['jobs']
+        options['method'] = args['sky_combine']
+        options['keep'] = args['keep']
+        options['backend'] = args['backend']
+    elif command in ('disp', 'calibrate'):
+        options['backend'] = args['backend']
+    elif command == 'reidentify':
+        options['reference'] = args['reference']
+    elif command == 'extract':
+        options['backend'] = args['backend']
+        options['keep'] = args['keep']
+        options['jobs'] = args['jobs']
+    return options
 
 if __name__ == '__main__':
     main(*parse_args())